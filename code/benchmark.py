@@ -0,0 +1,181 @@
+import pandas as pd, numpy as np, argparse, json, os, platform, subprocess
+from datetime import datetime
+
+from socialbrainapp import INSTRUMENTS, get_hardball_blocks, get_hardball_sessions, get_perceived_control, get_journey_sessions
+from ingest import IngestReport, Fingerprints, ingest_json
+from parallel import parallel_ingest
+from scoring import score_survey
+from synthetic import write_exports
+from metrics import RunMetrics, n_rows
+from enrollment import EnrollmentStats
+
+# Times and memory-profiles the preprocessing stages on synthetic exports (see synthetic.py):
+#   python benchmark.py --subjects 1000 10000 100000
+# Results are saved to <out_dir>/<date>-<git revision>.json; compare two runs with
+#   python benchmark.py --compare <old>.json <new>.json
+# Check that parsing with several workers gives the same records as parsing serially with
+#   python benchmark.py --check --subjects 1000 --workers 4
+
+SIZES = [1000, 10000, 100000]
+
+def _completed_hardball(dfs):
+    # Hardball trials of subjects with 60 trials or more, numbered within subject (as in preprocess.ipynb)
+    hardball_df = dfs['Hardball'].drop_duplicates().sort_values(by='Timestamp', kind='stable').sort_index(kind='stable')
+    ntrials = hardball_df.index.value_counts().reindex(hardball_df.index).to_numpy()
+    completed_df = hardball_df[ntrials >= 60].copy()
+    completed_df['NTrials'] = ntrials[ntrials >= 60].astype(float)
+    completed_df = completed_df.reset_index()
+    completed_df.index = completed_df.groupby('index').cumcount().to_numpy()
+    return completed_df
+
+def _write_outputs(outputs, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    for name, df in outputs.items():
+        df.to_csv(os.path.join(out_dir, f'{name}.csv'))
+
+def run_stages(json_files, out_dir, workers=1, trace_memory=True):
+    '''
+    Runs the preprocessing stages of preprocess.ipynb on the json files and returns their
+    metrics.RunMetrics (one entry per stage, and the slowest subjects of get_hardball_sessions).
+    '''
+    metrics = RunMetrics(trace_memory=trace_memory)
+    stage = metrics.run_stage
+
+    report = IngestReport()
+    dfs = stage('parse', parallel_ingest, json_files, report, None, workers, 1, None, Fingerprints())
+    metrics.report['stages'][-1]['rows_in'] = report.elements_read
+    metrics.add_ingest(report)
+
+    # counting subjects, completion and enrollment without building the tables
+    stats, status_report = EnrollmentStats(), IngestReport()
+    stage('status_only', ingest_json, json_files, status_report, None, None, Fingerprints(), stats, True)
+    metrics.report['stages'][-1].update(rows_in=status_report.elements_read, rows_out=stats.records)
+
+    completed_df = _completed_hardball(dfs)
+    blocks_df = stage('get_hardball_blocks', get_hardball_blocks, completed_df, 'index', rows_in=len(completed_df))
+    subject_times = {}
+    sessions_df = stage('get_hardball_sessions', get_hardball_sessions, blocks_df, 'index', subject_times, rows_in=len(blocks_df))
+    metrics.add_subject_times('get_hardball_sessions', subject_times)
+
+    ratings_df = dfs['HardballSubjectiveRatings'].drop_duplicates()
+    ratings_df = ratings_df[ratings_df.index.isin(completed_df['index'].unique())].sort_index(kind='stable').reset_index()
+    hardball_df = sessions_df.reset_index()
+    hardball_df = stage('get_perceived_control', get_perceived_control, hardball_df, ratings_df,
+                        rows_in=len(hardball_df) + len(ratings_df))
+
+    survey_dfs = {name: dfs[name] for name in INSTRUMENTS if name in dfs}
+    scores = stage('score_survey', lambda: {name: score_survey(df, name) for name, df in survey_dfs.items()},
+                   rows_in=n_rows(survey_dfs))
+
+    journey_dfs = [dfs['Journey_decisions'], dfs['Journey_characters'], dfs['Journey_memory']]
+    snt_df, mem_df, ver_df = stage('get_journey_sessions', get_journey_sessions, *journey_dfs, rows_in=n_rows(tuple(journey_dfs)))
+
+    outputs = {'Hardball': hardball_df, 'SNT': snt_df, 'SNT-memory': mem_df, 'SNT-ver': ver_df, **scores}
+    stage('write_outputs', _write_outputs, outputs, out_dir, rows_in=n_rows(outputs))
+    return metrics
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+def get_exports(work_dir, n_subjects, seed=0, **kwargs):
+    '''
+    Returns the json files of synthetic exports of n_subjects, written to work_dir/exports
+    (see synthetic.write_exports for kwargs) unless they are there already.
+    '''
+    export_dir = os.path.join(work_dir, 'exports', f'{n_subjects}-{seed}')
+    params_path = os.path.join(export_dir, 'params.json')
+    params = {'n_subjects': n_subjects, 'seed': seed, **kwargs}
+    if os.path.exists(params_path) and json.load(open(params_path)) == params:
+        return sorted(os.path.join(export_dir, f) for f in os.listdir(export_dir) if f.endswith('.json') and f != 'params.json')
+    json_files = write_exports(export_dir, n_subjects, seed=seed, **kwargs)
+    with open(params_path, 'w') as handle:
+        json.dump(params, handle)
+    return json_files
+
+def check_parallel(json_files, workers):
+    '''
+    Checks that parsing the first json file alone and all json files with workers processes
+    gives the same records and counts (see ingest.IngestReport) as parsing them serially. Raises AssertionError if not.
+    '''
+    for files in [json_files[:1], json_files]:
+        results = []
+        for n_workers in [1, workers]:
+            report = IngestReport()
+            results.append((parallel_ingest(files, report, workers=n_workers, fingerprints=Fingerprints()), report))
+        (serial_dfs, serial_report), (parallel_dfs, parallel_report) = results
+        assert serial_dfs.keys() == parallel_dfs.keys(), f'{len(files)} files: record types differ'
+        for record_type in serial_dfs:
+            pd.testing.assert_frame_equal(serial_dfs[record_type], parallel_dfs[record_type], obj=f'{len(files)} files: {record_type}')
+        for counts in ['elements_read', 'elements_without_records', 'records', 'duplicates', 'elements_skipped']:
+            assert getattr(serial_report, counts) == getattr(parallel_report, counts), f'{len(files)} files: {counts} differ'
+        print(f'{len(files)} files: {n_rows(parallel_dfs)} records, same as serial')
+
+def run_benchmark(sizes=SIZES, work_dir='../data/benchmarks', workers=1, trace_memory=True, seed=0, **kwargs):
+    '''
+    Generates synthetic exports of each size (number of subjects; kept in work_dir/exports and reused)
+    and runs the stages on them. kwargs are passed to synthetic.write_exports.
+    Saves and returns the results.
+    '''
+    revision = _git_revision()
+    run = {'revision': revision, 'date': datetime.now().isoformat(timespec='seconds'),
+           'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+           'workers': workers, 'trace_memory': trace_memory, 'seed': seed, 'export': kwargs, 'results': [], 'slowest_subjects': {}}
+
+    for n_subjects in sizes:
+        json_files = get_exports(work_dir, n_subjects, seed, **kwargs)
+        metrics = run_stages(json_files, os.path.join(work_dir, 'outputs'), workers=workers, trace_memory=trace_memory)
+        run['slowest_subjects'][n_subjects] = metrics.report['subjects']['get_hardball_sessions']['slowest']
+        for result in metrics.report['stages']:
+            run['results'].append({'subjects': n_subjects, **result})
+            peak = f"{result['peak_mb']:9.1f}MB" if 'peak_mb' in result else ''
+            print(f"{n_subjects:>7} {result['stage']:<22} {result['wall_s']:8.2f}s {result['cpu_s']:8.2f}s cpu {peak} "
+                  f"{result['rows_in']!s:>10} -> {result['rows_out']!s}")
+
+    path = os.path.join(work_dir, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{revision}.json")
+    with open(path, 'w') as handle:
+        json.dump(run, handle, indent=1)
+    print(f'saved {path}')
+    return run
+
+def compare(old_path, new_path):
+    '''
+    Returns the metrics of two saved runs side by side, with new / old ratios.
+    '''
+    runs = []
+    for path in [old_path, new_path]:
+        with open(path) as handle:
+            runs.append(pd.DataFrame(json.load(handle)['results']).set_index(['subjects', 'stage']))
+    old_df, new_df = runs
+    metrics = [col for col in ['wall_s', 'cpu_s', 'peak_mb'] if col in old_df and col in new_df]
+    compare_df = old_df[metrics].join(new_df[metrics], lsuffix='_old', rsuffix='_new', how='outer')
+    for col in metrics:
+        compare_df[f'{col}_ratio'] = compare_df[f'{col}_new'] / compare_df[f'{col}_old']
+    return compare_df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing stages on synthetic exports')
+    parser.add_argument('--subjects', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--work-dir', default='../data/benchmarks')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory (faster, more accurate timings)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--files', type=int, default=10, help='json exports per size')
+    parser.add_argument('--duplicates', type=float, default=0.02)
+    parser.add_argument('--malformed', type=float, default=0.0005)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--check', action='store_true', help='check that parallel parsing (--workers) matches serial parsing')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare(*args.compare).round(3).to_string())
+    elif args.check:
+        for n_subjects in args.subjects:
+            check_parallel(get_exports(args.work_dir, n_subjects, args.seed, n_files=args.files, duplicates=args.duplicates,
+                                       malformed=args.malformed), max(args.workers, 2))
+    else:
+        run_benchmark(args.subjects, args.work_dir, workers=args.workers, trace_memory=not args.no_memory, seed=args.seed,
+                      n_files=args.files, duplicates=args.duplicates, malformed=args.malformed)
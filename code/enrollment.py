@@ -0,0 +1,229 @@
+import pandas as pd, numpy as np, argparse, hashlib, json, os
+from collections import Counter
+from datetime import datetime
+from glob import glob
+
+from socialbrainapp import RECORD_TYPES, INSTRUMENTS, HARDBALL_MIN_TRIALS, JOURNEY_MIN_TRIALS, valid_timestamp
+from ingest import IngestReport, ingest_json
+from incremental import Checkpoint
+
+# Counts of subjects, completion and enrollment, kept up to date while json exports are parsed.
+# For a quick status of new exports without preprocessing them:
+#   python enrollment.py ../json --state-dir ../data/state --out status.json
+
+HLL_PRECISION = 14 # 2**14 registers, about 0.8% standard error
+SAVE_EVERY = 100000 # records counted between saves of the status file
+
+# records a subject needs to complete each task: Hardball trials, Journey decisions and distinct survey items
+COMPLETION = {'Hardball': HARDBALL_MIN_TRIALS, 'Journey_decisions': JOURNEY_MIN_TRIALS,
+              **{instrument: spec['n_items'] for instrument, spec in INSTRUMENTS.items()}}
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'little')
+
+class HyperLogLog:
+    '''
+    Approximate count of distinct values (len) in 2**precision bytes, with a standard error
+    of about 1.04 / sqrt(2**precision). update() adds the values of another count,
+    so it can stand in for a set.
+    '''
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        fingerprint = _hash64(value)
+        bits = 64 - self.precision
+        rest = fingerprint & ((1 << bits) - 1)
+        index = fingerprint >> bits
+        # position of the first 1 bit in the rest of the hash
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        registers = np.maximum(np.frombuffer(self.registers, dtype=np.uint8), np.frombuffer(other.registers, dtype=np.uint8))
+        self.registers = bytearray(registers.tobytes())
+
+    def __len__(self):
+        registers = np.frombuffer(self.registers, dtype=np.uint8)
+        m = len(registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.exp2(-registers.astype(float)))
+        # small counts are estimated from the empty registers
+        zeros = np.count_nonzero(registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+def _item_bit(question):
+    # bit of a survey item in a subject's mask of answered items (0 for items that are not small integers)
+    try:
+        question = int(question)
+    except (TypeError, ValueError):
+        return 0
+    return 1 << question if 0 <= question < 63 else 0
+
+class EnrollmentStats:
+    '''
+    Counts of the records of an ingest, updated record by record (add, from ingest.ingest_json) or
+    frame by frame (add_frames, from parallel.parallel_ingest):
+    - subjects: distinct subjects with records of each record type
+    - completed: distinct subjects who reached the COMPLETION threshold of a record type
+      (Hardball trials, Journey decisions, distinct survey items)
+    - enrollment: Demographics records per date
+    Per subject, only the record counts of tasks not completed yet are kept. With approximate,
+    distinct subjects are counted with a HyperLogLog of fixed size instead of sets.
+    As when records are built, elements skipped as duplicates (see ingest.Fingerprints) and records
+    whose Timestamp does not parse are not counted.
+    If path is set, the counts are saved there as json every save_every records, so they can be
+    followed during long ingests. Across runs, incremental.Checkpoint keeps one EnrollmentStats and
+    counts the records of each run into it.
+    '''
+    def __init__(self, approximate=False, precision=HLL_PRECISION, path=None, save_every=SAVE_EVERY):
+        self.approximate = approximate
+        self.precision = precision
+        self.path = path
+        self.save_every = save_every
+        self.records = 0
+        self.subjects = {} # per record type
+        self.completed = {} # per record type in COMPLETION
+        self.progress = {} # per record type in COMPLETION, {subject: records (or mask of survey items)} until completed
+        self.enrollment = Counter() # per date (YYYY-MM-DD)
+        self._next_save = save_every
+
+    def __getstate__(self):
+        # the status file belongs to one run
+        return {**self.__dict__, 'path': None}
+
+    def _distinct(self):
+        return HyperLogLog(self.precision) if self.approximate else set()
+
+    def _add_subject(self, record_type, user_id):
+        if record_type not in self.subjects:
+            self.subjects[record_type] = self._distinct()
+        self.subjects[record_type].add(user_id)
+
+    def _add_progress(self, record_type, user_id, value):
+        progress = self.progress.setdefault(record_type, {})
+        if record_type in INSTRUMENTS:
+            value |= progress.get(user_id, 0)
+            done = bin(value).count('1') >= COMPLETION[record_type]
+        else:
+            value += progress.get(user_id, 0)
+            done = value >= COMPLETION[record_type]
+
+        if done:
+            if record_type not in self.completed:
+                self.completed[record_type] = self._distinct()
+            self.completed[record_type].add(user_id)
+            progress.pop(user_id, None)
+        else:
+            progress[user_id] = value
+
+    def add(self, element, record_types):
+        '''
+        Counts the records of a json element (see socialbrainapp.get_records).
+        '''
+        if not valid_timestamp(element['Timestamp']):
+            return
+        user_id = element['UserId']
+        for record_type in record_types:
+            self._add_subject(record_type, user_id)
+            if record_type in COMPLETION:
+                self._add_progress(record_type, user_id, _item_bit(element['SurveyQuestion']) if record_type in INSTRUMENTS else 1)
+            elif record_type == 'Demographics':
+                self.enrollment[element['Timestamp'][:10]] += 1
+        self.records += len(record_types)
+        if self.path is not None and self.records >= self._next_save:
+            self.save()
+
+    def add_frames(self, dfs):
+        '''
+        Counts the records of DataFrames per record type (indexed by UserId, as from ingest.ingest_json).
+        '''
+        for record_type, df in dfs.items():
+            subjects = df.index.get_level_values(0)
+            for user_id in subjects.unique():
+                self._add_subject(record_type, user_id)
+
+            if record_type in INSTRUMENTS:
+                bits = pd.Series([_item_bit(question) for question in df['SurveyQuestion'].unique()],
+                                 index=df['SurveyQuestion'].unique(), dtype=object)
+                items = pd.DataFrame({'UserId': subjects, 'Bit': bits.reindex(df['SurveyQuestion']).to_numpy()})
+                values = items.drop_duplicates().groupby('UserId', sort=False)['Bit'].sum()
+            elif record_type in COMPLETION:
+                values = subjects.value_counts(sort=False)
+            else:
+                values = None
+            if values is not None:
+                for user_id, value in values.items():
+                    self._add_progress(record_type, user_id, int(value))
+
+            if record_type == 'Demographics':
+                self.enrollment.update(df['Timestamp'].dt.strftime('%Y-%m-%d').value_counts().to_dict())
+            self.records += len(df)
+        if self.path is not None:
+            self.save()
+
+    def counts(self):
+        '''
+        Returns the number of subjects with records of each record type (Subjects) and,
+        for record types in COMPLETION, the number of subjects who completed the task (Completed).
+        '''
+        counts = pd.DataFrame({'Subjects': pd.Series({record_type: len(subjects) for record_type, subjects in self.subjects.items()}, dtype='Int64'),
+                               'Completed': pd.Series({record_type: len(self.completed.get(record_type, ())) for record_type in COMPLETION
+                                                       if record_type in self.subjects}, dtype='Int64')})
+        return counts.reindex([record_type for record_type in RECORD_TYPES if record_type in counts.index])
+
+    def enrollment_by_date(self):
+        '''
+        Returns the number of Demographics records per date (a Series with a DatetimeIndex).
+        '''
+        enrollment = pd.Series(self.enrollment, dtype=int, name='Enrolled')
+        enrollment.index = pd.to_datetime(enrollment.index)
+        return enrollment.sort_index()
+
+    def save(self):
+        if self.path is None:
+            return
+        self._next_save = self.records + self.save_every
+        counts = self.counts()
+        status = {'updated': datetime.now().isoformat(timespec='seconds'), 'approximate': self.approximate, 'records': self.records,
+                  'subjects': counts['Subjects'].astype(int).to_dict(),
+                  'completed': counts['Completed'].dropna().astype(int).to_dict(),
+                  'completion': COMPLETION, 'enrollment': dict(sorted(self.enrollment.items()))}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as handle:
+            json.dump(status, handle, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def summary(self):
+        lines = [f'{self.records} records counted' + (' (approximate subject counts)' if self.approximate else '')]
+        for record_type, row in self.counts().iterrows():
+            completed = f", {row['Completed']} completed ({COMPLETION[record_type]}+)" if record_type in COMPLETION else ''
+            lines.append(f"  {record_type}: {row['Subjects']} subjects{completed}")
+        if self.enrollment:
+            lines.append(f'{sum(self.enrollment.values())} enrolled from {min(self.enrollment)} to {max(self.enrollment)}')
+        return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count subjects, completion and enrollment of the json exports without preprocessing them')
+    parser.add_argument('json_dir', nargs='?', default='../json')
+    parser.add_argument('--state-dir', default='../data/state',
+                        help='add the jsons not processed yet to the counts kept there by preprocess.ipynb ("none" to count all jsons alone)')
+    parser.add_argument('--approximate', action='store_true', help='count distinct subjects in bounded memory (when not adding to saved counts)')
+    parser.add_argument('--out', help='status json, updated while counting')
+    args = parser.parse_args()
+
+    # the checkpoint is only read: nothing is committed, so the next preprocessing run is not affected
+    checkpoint = Checkpoint(None if args.state_dir.lower() == 'none' else args.state_dir)
+    json_files = checkpoint.get_new_files(sorted(glob(f'{args.json_dir}/*json')))
+    stats = checkpoint.enrollment if checkpoint.enrollment is not None else EnrollmentStats(approximate=args.approximate)
+    stats.path = args.out
+
+    report = IngestReport()
+    ingest_json(json_files, report, fingerprints=checkpoint.fingerprints, stats=stats, status_only=True)
+    stats.save()
+    print(f'{len(json_files)} jsons not processed yet')
+    print(report.summary())
+    print(stats.summary())
@@ -0,0 +1,181 @@
+import pandas as pd, json, pickle, os, hashlib
+
+from socialbrainapp import RECORD_TYPES, concat_records
+from ingest import Fingerprints
+from store import partition_by_subject
+
+MANIFEST_FILE = 'manifest.json'
+VALUES_FILE = 'values.json'
+FINGERPRINTS_FILE = 'fingerprints.npy'
+ENROLLMENT_FILE = 'enrollment.pickle'
+
+def file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def _write_atomic(path, write, mode='wb'):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode) as handle:
+        write(handle)
+    os.replace(tmp_path, path)
+
+def _subject_ids(df, subject_col=None):
+    return df[subject_col] if subject_col is not None else df.index.get_level_values(0)
+
+class Checkpoint:
+    '''
+    State kept between incremental runs in state_dir:
+    - manifest.json: json files already processed (path, size, mtime and sha1)
+    - values.json: lists accumulated over runs (e.g. withdrawal ids)
+    - fingerprints.npy: fingerprints of the json elements parsed (see ingest.Fingerprints)
+    - enrollment.pickle: counts of subjects, completion and enrollment (see enrollment.EnrollmentStats)
+    - parsed/<record type>.pickle: parsed records of all processed files
+    - stages/<stage name>.pickle: per-subject outputs of preprocessing stages
+
+    Only files missing from the manifest are parsed, and stages are only rerun for subjects
+    with new records. Export files are assumed to be append-only (a file whose content
+    changed is parsed again in full, and duplicate records are dropped downstream).
+    Nothing is written until commit(), so a failed run leaves the previous state intact.
+    With state_dir=None nothing is kept and every run is a full run.
+    '''
+    def __init__(self, state_dir=None):
+        self.state_dir = state_dir
+        self.manifest = {}
+        self.values = {}
+        self.parsed = {}
+        self.stages = {}
+        self.new_files = []
+        self._hashes = {}
+        self.fingerprints = Fingerprints(os.path.join(state_dir, FINGERPRINTS_FILE) if state_dir is not None else None)
+        self.enrollment = None
+
+        if state_dir is not None:
+            os.makedirs(os.path.join(state_dir, 'parsed'), exist_ok=True)
+            os.makedirs(os.path.join(state_dir, 'stages'), exist_ok=True)
+            self.manifest = self._load_json(MANIFEST_FILE)
+            self.values = self._load_json(VALUES_FILE)
+            self.enrollment = self._load_pickle('', os.path.splitext(ENROLLMENT_FILE)[0])
+
+    def _load_json(self, name):
+        path = os.path.join(self.state_dir, name)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as handle:
+            return json.load(handle)
+
+    def _load_pickle(self, folder, name):
+        if self.state_dir is None:
+            return None
+        path = os.path.join(self.state_dir, folder, f'{name}.pickle')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as handle:
+            return pickle.load(handle)
+
+    def get_new_files(self, json_files):
+        '''
+        Returns the json files that have not been processed yet.
+        A file counts as processed if the manifest has the same path, size and mtime,
+        or (e.g. after it was moved) any file with the same size and sha1.
+        '''
+        known_hashes = {(entry['size'], entry['sha1']) for entry in self.manifest.values()}
+        self.new_files = []
+        for json_file in json_files:
+            stat = os.stat(json_file)
+            entry = self.manifest.get(os.path.abspath(json_file))
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                continue
+            self._hashes[json_file] = file_hash(json_file)
+            if (stat.st_size, self._hashes[json_file]) in known_hashes:
+                continue
+            self.new_files.append(json_file)
+        return list(self.new_files)
+
+    def accumulate(self, name, new_values):
+        '''
+        Adds new_values to the list stored under name and returns the full list.
+        '''
+        self.values[name] = self.values.get(name, []) + list(new_values)
+        return list(self.values[name])
+
+    def add_parsed(self, new_dfs):
+        '''
+        Appends newly parsed records to the stored records of earlier runs.
+        Returns the records of all runs and the set of subjects with new records per record type.
+        '''
+        stored_types = [os.path.splitext(f)[0] for f in self._parsed_files()]
+        full_dfs = {}
+        changed_ids = {}
+        for record_type in [r for r in RECORD_TYPES if r in new_dfs or r in stored_types]:
+            old_df = self._load_pickle('parsed', record_type)
+            new_df = new_dfs.get(record_type)
+            dfs = [df for df in [old_df, new_df] if df is not None]
+            full_dfs[record_type] = concat_records(dfs, record_type) if len(dfs) > 1 else dfs[0]
+            changed_ids[record_type] = set(new_df.index) if new_df is not None else set()
+
+        # only record types with new records need saving
+        self.parsed = {record_type: full_dfs[record_type] for record_type in new_dfs}
+        return full_dfs, changed_ids
+
+    def _parsed_files(self):
+        if self.state_dir is None:
+            return []
+        return os.listdir(os.path.join(self.state_dir, 'parsed'))
+
+    def run_stage(self, name, func, df, changed_ids, subject_col=None):
+        '''
+        Runs a per-subject preprocessing stage, func(df) -> DataFrame, where subjects are
+        given by subject_col (or the index) in both input and output.
+        Cached outputs are reused for subjects not in changed_ids, so func only sees the rows
+        of changed subjects. Output is sorted by subject, as from a full run.
+        '''
+        cached = self._load_pickle('stages', name)
+        if cached is None:
+            output = func(df)
+        else:
+            changed = list(changed_ids)
+            changed_df = df[_subject_ids(df, subject_col).isin(changed)]
+            kept = cached[~_subject_ids(cached, subject_col).isin(changed)]
+            outputs = [kept] + ([func(changed_df)] if len(changed_df) else [])
+            output = pd.concat(outputs)
+
+            # pd.concat turns categories that differ between frames into objects
+            for col in output.columns:
+                if any(isinstance(df[col].dtype, pd.CategoricalDtype) for df in outputs if col in df.columns):
+                    output[col] = output[col].astype('category')
+
+            # same subject order as a full run (stable, so each subject keeps its row order)
+            output = partition_by_subject(output, subject_col).data
+
+        self.stages[name] = output
+        return output
+
+    def commit(self):
+        '''
+        Saves the parsed records, stage outputs, lists, enrollment counts and fingerprints and adds the new files to the manifest.
+        '''
+        if self.state_dir is None:
+            return
+
+        for folder, dfs in [('parsed', self.parsed), ('stages', self.stages)]:
+            for name, df in dfs.items():
+                path = os.path.join(self.state_dir, folder, f'{name}.pickle')
+                _write_atomic(path, lambda handle: pickle.dump(df, handle, protocol=pickle.HIGHEST_PROTOCOL))
+        if self.enrollment is not None:
+            _write_atomic(os.path.join(self.state_dir, ENROLLMENT_FILE),
+                          lambda handle: pickle.dump(self.enrollment, handle, protocol=pickle.HIGHEST_PROTOCOL))
+
+        # after the records, so elements are only remembered once their records are saved
+        self.fingerprints.save()
+
+        for json_file in self.new_files:
+            stat = os.stat(json_file)
+            self.manifest[os.path.abspath(json_file)] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                                                         'sha1': self._hashes[json_file]}
+        self.new_files = []
+
+        _write_atomic(os.path.join(self.state_dir, VALUES_FILE), lambda handle: json.dump(self.values, handle), mode='w')
+        _write_atomic(os.path.join(self.state_dir, MANIFEST_FILE), lambda handle: json.dump(self.manifest, handle, indent=1), mode='w')
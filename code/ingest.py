@@ -0,0 +1,329 @@
+import numpy as np, json, hashlib, os, re
+from collections import Counter
+
+from socialbrainapp import RecordBuffers, get_record_types, element_records, error_reason, invalid_timestamp_reason
+
+CHUNK_SIZE = 1 << 20 # characters read from a json file at a time
+MAX_ELEMENT_SIZE = 1 << 26 # give up on a file if a single element is larger than this
+MAX_EXAMPLES = 100 # skipped elements kept as examples in the report
+
+_decoder = json.JSONDecoder()
+_number_tail = re.compile(r'(?:[.eE][-+0-9eE]*)?\Z') # the rest of the buffer may still continue a number
+_canonical_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False, check_circular=False)
+
+class MalformedJSONError(ValueError):
+    pass
+
+def iter_json_array(json_file, chunk_size=CHUNK_SIZE):
+    '''
+    Yields the elements of a file holding one json array, one element at a time.
+    The file is read in chunks, so memory is bounded by the chunk size and the largest element.
+    Raises MalformedJSONError where the file stops being a valid json array, including anything
+    but whitespace after the closing bracket (e.g. a second array).
+    '''
+    with open(json_file, 'r', encoding='utf-8') as handle:
+        buf = ''
+        pos = 0
+        eof = False
+        # what comes next: 'start' ([), 'first' (element or ]), 'element', 'separator' (, or ]), 'end' (whitespace only)
+        state = 'start'
+
+        def read_more(buf, pos):
+            chunk = handle.read(chunk_size)
+            return buf[pos:] + chunk, 0, not chunk
+
+        while True:
+            # skip whitespace
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    if state == 'end':
+                        return
+                    raise MalformedJSONError('empty file' if state == 'start' else 'unexpected end of file')
+                buf, pos, eof = read_more(buf, pos)
+                continue
+
+            char = buf[pos]
+            if state == 'start':
+                if char != '[':
+                    raise MalformedJSONError(f'expected a json array, found {char!r}')
+                state = 'first'
+                pos += 1
+                continue
+            if state == 'end':
+                raise MalformedJSONError(f'unexpected {char!r} after the json array')
+            if state == 'separator':
+                if char not in ',]':
+                    raise MalformedJSONError(f'expected , or ] after element, found {char!r}')
+                state = 'element' if char == ',' else 'end'
+                pos += 1
+                continue
+            if char == ']' and state == 'first':
+                state = 'end'
+                pos += 1
+                continue
+            if char in ',]':
+                raise MalformedJSONError(f'expected an element, found {char!r}')
+
+            try:
+                element, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as err:
+                # the element may continue in the next chunk
+                if eof:
+                    raise MalformedJSONError(f'invalid element ({err.msg})') from None
+                if len(buf) - pos > MAX_ELEMENT_SIZE:
+                    raise MalformedJSONError(f'element larger than {MAX_ELEMENT_SIZE} characters') from None
+                buf, pos, eof = read_more(buf, pos)
+                continue
+
+            # a number at the end of the buffer may be cut off (e.g. 1.5 read as 1 before .5),
+            # so only accept an element once the next character is seen to end it
+            if not eof and _number_tail.match(buf, end):
+                buf, pos, eof = read_more(buf, pos)
+                continue
+
+            pos = end
+            state = 'separator'
+            yield element
+
+class IngestReport:
+    '''
+    Counts of what was read during ingestion, and what was skipped and why.
+    '''
+    def __init__(self, max_examples=MAX_EXAMPLES):
+        self.max_examples = max_examples
+        self.files_parsed = []
+        self.files_skipped = [] # (json_file, reason)
+        self.elements_read = 0
+        self.elements_without_records = 0
+        self.records = Counter() # per record type
+        self.duplicates = Counter() # records of elements seen before, per record type
+        self.elements_skipped = Counter() # per reason
+        self.skipped_examples = [] # (json_file, position in file, reason), no file for invalid timestamps
+
+    def skip_element(self, json_file, position, reason):
+        self.elements_skipped[reason] += 1
+        if len(self.skipped_examples) < self.max_examples:
+            self.skipped_examples.append((json_file, position, reason))
+
+    def skip_file(self, json_file, reason):
+        self.files_skipped.append((json_file, reason))
+
+    def merge(self, other):
+        '''
+        Adds the counts of another report (e.g. from a worker process) to this one.
+        '''
+        self.files_parsed += other.files_parsed
+        self.files_skipped += other.files_skipped
+        self.elements_read += other.elements_read
+        self.elements_without_records += other.elements_without_records
+        self.records.update(other.records)
+        self.duplicates.update(other.duplicates)
+        self.elements_skipped.update(other.elements_skipped)
+        self.skipped_examples = (self.skipped_examples + other.skipped_examples)[:self.max_examples]
+
+    def summary(self):
+        lines = [f'{len(self.files_parsed)} files parsed, {len(self.files_skipped)} files skipped or cut short',
+                 f'{self.elements_read} elements read, {sum(self.elements_skipped.values())} skipped, '
+                 f'{self.elements_without_records} without records']
+        lines += [f'  {record_type}: {count} records' for record_type, count in self.records.items()]
+        lines += [f'  {record_type}: {count} duplicate records skipped' for record_type, count in self.duplicates.items()]
+        lines += [f'  file {json_file}: {reason}' for json_file, reason in self.files_skipped]
+        lines += [f'  element skipped {count}x: {reason}' for reason, count in self.elements_skipped.most_common()]
+        return '\n'.join(lines)
+
+class Withdrawals:
+    '''
+    Collects the UserIds of elements with Withdrawal == 'True' (withdraw_ids) and
+    WithdrawalShare == 'True' (withdrawshare_ids), in the order seen.
+    Pass as on_element to ingest_json.
+    '''
+    def __init__(self):
+        self.withdraw_ids = []
+        self.withdrawshare_ids = []
+
+    def __call__(self, element):
+        if not isinstance(element, dict) or 'UserId' not in element:
+            return
+
+        if element.get('Withdrawal') == 'True':
+            self.withdraw_ids.append(element['UserId'])
+
+        if element.get('WithdrawalShare') == 'True':
+            self.withdrawshare_ids.append(element['UserId'])
+
+    def merge(self, other):
+        self.withdraw_ids += other.withdraw_ids
+        self.withdrawshare_ids += other.withdrawshare_ids
+
+# keys of the json elements that decide which records they hold (see socialbrainapp.get_record_types)
+RECORD_KEYS = ['Age', 'SurveyName', 'Game', 'Screen', 'Task', 'CharFirstX']
+
+def element_fingerprint(element):
+    '''
+    Returns a 64-bit content fingerprint of a json element: a hash of its record keys and its
+    content (UserId, Timestamp and all other fields, in a canonical key order).
+    '''
+    kind = ','.join(key for key in RECORD_KEYS if key in element)
+    content = _canonical_encoder.encode(element)
+    digest = hashlib.blake2b(f'{kind}|{content}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+class Fingerprints:
+    '''
+    Fingerprints of the elements already ingested, so elements delivered again (by overlapping
+    exports) are skipped before they are parsed. Fingerprints of earlier runs are kept in path
+    (a sorted .npy array, memory-mapped when used) and the new ones are added by save().
+    With path=None only duplicates within the run are skipped.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.new = set() # fingerprints first seen in this run
+        self.row_fingerprints = {} # per record type, fingerprint of each parsed row (see RecordBuffers)
+        self.no_record_fingerprints = set() # fingerprints of the parsed elements without records
+        self._known = None
+
+    def __getstate__(self):
+        # sent to worker processes without the fingerprints of earlier runs (they load them from path)
+        return {**self.__dict__, '_known': None}
+
+    @property
+    def known(self):
+        if self._known is None:
+            if self.path is not None and os.path.exists(self.path):
+                self._known = np.load(self.path, mmap_mode='r')
+            else:
+                self._known = np.zeros(0, dtype=np.uint64)
+        return self._known
+
+    def seen(self, fingerprint):
+        if fingerprint in self.new:
+            return True
+        known = self.known
+        if not len(known):
+            return False
+        i = np.searchsorted(known, np.uint64(fingerprint))
+        return i < len(known) and known[i] == fingerprint
+
+    def add(self, fingerprint):
+        self.new.add(fingerprint)
+
+    def merge(self, other, dfs, report=None):
+        '''
+        Adds the fingerprints of another (e.g. from a worker process that parsed later files) and
+        returns its parsed records (dfs) without the rows of elements already seen here.
+        The dropped rows are counted as duplicates in the report, and the elements without records
+        already seen here are no longer counted as such.
+        '''
+        kept_dfs = {}
+        for record_type, df in dfs.items():
+            duplicate = np.array([fingerprint in self.new for fingerprint in other.row_fingerprints[record_type].tolist()], dtype=bool)
+            if duplicate.any():
+                df = df[~duplicate]
+                if report is not None:
+                    report.records[record_type] -= int(duplicate.sum())
+                    report.duplicates[record_type] += int(duplicate.sum())
+            kept_dfs[record_type] = df
+        if report is not None:
+            report.elements_without_records -= len(other.no_record_fingerprints & self.new)
+        self.new |= other.new
+        return kept_dfs
+
+    def save(self):
+        '''
+        Adds the new fingerprints to the ones of earlier runs in path.
+        '''
+        if self.path is None:
+            return
+        fingerprints = np.union1d(self.known, np.fromiter(self.new, dtype=np.uint64, count=len(self.new)))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as handle:
+            np.save(handle, fingerprints)
+        os.replace(tmp_path, self.path)
+        self._known = None
+        self.new = set()
+
+def iter_elements(json_files, report=None):
+    '''
+    Yields (json_file, position, element) for every element of every json file.
+    Files that cannot be read are recorded in the report; elements read before the error are kept.
+    '''
+    report = IngestReport() if report is None else report
+    for json_file in json_files:
+        position = 0
+        try:
+            for element in iter_json_array(json_file):
+                report.elements_read += 1
+                yield json_file, position, element
+                position += 1
+        except (OSError, UnicodeDecodeError, MalformedJSONError) as err:
+            report.skip_file(json_file, f'{error_reason(err)} (after {position} elements)')
+        else:
+            report.files_parsed.append(json_file)
+
+WITHDRAWN_REASON = 'subject withdrew data'
+
+def ingest_json(json_files, report=None, on_element=None, exclude_ids=None, fingerprints=None, stats=None, status_only=False):
+    '''
+    Streams the elements of the json export files into one DataFrame per record type
+    (see socialbrainapp.parse_elements), dispatching each element by its keys
+    (Age / SurveyName / Game / Screen / Task / CharFirstX).
+    Elements and files that cannot be parsed are recorded in the report instead of raising.
+    on_element, if given, is called with every element before it is dispatched.
+    Elements of subjects in exclude_ids (e.g. socialbrainapp.get_withdrawn_data_ids of the
+    withdrawals of earlier runs) are not parsed and are reported as skipped.
+    With fingerprints (a Fingerprints index), elements seen before are not parsed and
+    their records are counted as duplicates in the report.
+    With stats (an enrollment.EnrollmentStats), the records of each element are counted as it is read.
+    With status_only, elements are only dispatched and counted, no DataFrames are built and {} is returned
+    (fingerprints are then only added in memory and should not be saved).
+    '''
+    report = IngestReport() if report is None else report
+    buffers = RecordBuffers()
+    no_record_fingerprints = set()
+    for json_file, position, element in iter_elements(json_files, report):
+        if on_element is not None:
+            on_element(element)
+        if exclude_ids and isinstance(element, dict) and element.get('UserId') in exclude_ids:
+            report.skip_element(json_file, position, WITHDRAWN_REASON)
+            continue
+
+        fingerprint = None
+        if fingerprints is not None and isinstance(element, dict):
+            fingerprint = element_fingerprint(element)
+            if fingerprints.seen(fingerprint):
+                report.duplicates.update(get_record_types(element))
+                continue
+
+        try:
+            if status_only:
+                record_types = [record_type for record_type, _ in element_records(element)[1]]
+            else:
+                record_types = buffers.add_element(element, fingerprint)
+        except Exception as err:
+            report.skip_element(json_file, position, error_reason(err))
+            continue
+        if fingerprint is not None:
+            fingerprints.add(fingerprint)
+        if stats is not None and record_types:
+            stats.add(element, record_types)
+
+        if record_types:
+            report.records.update(record_types)
+        else:
+            report.elements_without_records += 1
+            if fingerprint is not None:
+                no_record_fingerprints.add(fingerprint)
+
+    dfs = buffers.to_frames()
+    for record_type, user_id, timestamp in buffers.invalid_timestamps:
+        report.records[record_type] -= 1
+        report.skip_element(None, None, invalid_timestamp_reason(record_type))
+
+    # elements that were not parsed are not remembered, so they are tried again in later runs
+    if fingerprints is not None:
+        fingerprints.new -= buffers.invalid_fingerprints
+        fingerprints.row_fingerprints = buffers.row_fingerprints
+        fingerprints.no_record_fingerprints = no_record_fingerprints
+    return dfs
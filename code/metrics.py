@@ -0,0 +1,186 @@
+import pandas as pd, numpy as np, json, os, sys, platform, time, tracemalloc, cProfile, pstats
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError: # not on Windows, where max RSS is not reported
+    resource = None
+
+from socialbrainapp import error_reason
+
+N_SLOWEST = 20 # slowest subjects kept per stage
+N_FUNCTIONS = 30 # functions kept (by cumulative time) from each stage profile
+
+def n_rows(result):
+    '''
+    Rows of a DataFrame, or of all DataFrames in a dict or tuple.
+    '''
+    if isinstance(result, dict):
+        return sum(n_rows(value) for value in result.values())
+    if isinstance(result, tuple):
+        return sum(n_rows(value) for value in result)
+    return len(result)
+
+def _max_rss_mb(children=False):
+    # high-water mark of the process (or of its finished worker processes) so far
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss / 1e6 if sys.platform == 'darwin' else max_rss / 1e3
+
+def _to_json(obj):
+    return obj.item() if isinstance(obj, np.generic) else str(obj)
+
+@contextmanager
+def timed(trace_memory=False, profiler=None):
+    '''
+    Yields a dict that is filled with the wall time and CPU time (s) of the with block when it ends
+    and, if trace_memory, the peak memory allocated in it (MB, from tracemalloc, which slows
+    allocation-heavy code down). profiler (e.g. a cProfile.Profile) is enabled during the block.
+    '''
+    metrics = {}
+    tracing = trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield metrics
+    finally:
+        metrics['wall_s'] = time.perf_counter() - wall
+        metrics['cpu_s'] = time.process_time() - cpu
+        if profiler is not None:
+            profiler.disable()
+        if tracing:
+            metrics['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+
+def measure(func, *args, trace_memory=True, **kwargs):
+    '''
+    Calls func and returns its result and its metrics (see timed).
+    '''
+    with timed(trace_memory) as metrics:
+        result = func(*args, **kwargs)
+    return result, metrics
+
+def _profile_top(profiler, n_functions=N_FUNCTIONS):
+    stats = pstats.Stats(profiler).stats
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:n_functions]
+    return [{'function': f'{file}:{line}({func})', 'calls': calls, 'tottime': tottime, 'cumtime': cumtime}
+            for (file, line, func), (_, calls, tottime, cumtime, _) in top]
+
+class RunMetrics:
+    '''
+    Metrics of one preprocessing run, kept as a json report in path (e.g. next to the dated outputs):
+    - stages: wall and CPU time, max RSS (of the process and of finished worker processes),
+      rows in and out and, with trace_memory, peak memory allocated (see timed) of each stage,
+      and the error if the stage raised one
+    - ingest: counts of an ingest.IngestReport (files and elements skipped by reason, duplicates)
+    - subjects: the slowest subjects of per-subject stages (e.g. get_hardball_sessions)
+    Stages named in profile (True for all) are run under cProfile; the stats are saved next to
+    the report (<report>-<stage>.prof, for pstats or snakeviz) and the slowest functions are kept in it.
+    Only the calling process is profiled, so profile per-subject stages with workers=1.
+    The report is saved after every stage, so a run that fails or is stopped still leaves one.
+    info is added to the report as is (e.g. number of workers).
+    '''
+    def __init__(self, path=None, trace_memory=False, profile=(), n_slowest=N_SLOWEST, **info):
+        self.path = path
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.n_slowest = n_slowest
+        self.report = {'started': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+                       'pandas': pd.__version__, 'numpy': np.__version__, 'info': info,
+                       'stages': [], 'ingest': None, 'subjects': {}}
+
+    def _profiled(self, name):
+        return self.profile is True or name in self.profile
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        '''
+        Records the code in the with block as stage name. Yields the stage's entry in the report,
+        so rows_out (or any other field) can be set in the block.
+        An exception in the block is recorded as the stage's error and raised again.
+        '''
+        entry = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        self.report['stages'].append(entry)
+        profiler = cProfile.Profile() if self._profiled(name) else None
+        try:
+            with timed(self.trace_memory, profiler) as metrics:
+                yield entry
+        except Exception as err:
+            entry['error'] = error_reason(err)
+            raise
+        finally:
+            entry.update(metrics)
+            entry['max_rss_mb'] = _max_rss_mb()
+            entry['workers_max_rss_mb'] = _max_rss_mb(children=True)
+            if profiler is not None:
+                entry['profile'] = self._save_profile(name, profiler)
+            self.save()
+
+    def run_stage(self, name, func, *args, rows_in=None, **kwargs):
+        '''
+        Calls func as stage name and returns its result; rows_out is counted from the result (see n_rows).
+        '''
+        with self.stage(name, rows_in) as entry:
+            result = func(*args, **kwargs)
+            entry['rows_out'] = n_rows(result) if result is not None else None
+        return result
+
+    def _save_profile(self, name, profiler):
+        profile = {'path': None, 'top': _profile_top(profiler)}
+        if self.path is not None:
+            profile['path'] = f'{os.path.splitext(self.path)[0]}-{name}.prof'
+            profiler.dump_stats(profile['path'])
+        return profile
+
+    def add_ingest(self, report):
+        '''
+        Adds the counts of an ingest.IngestReport.
+        '''
+        self.report['ingest'] = {'files_parsed': len(report.files_parsed), 'files_skipped': report.files_skipped,
+                                 'elements_read': report.elements_read,
+                                 'elements_without_records': report.elements_without_records,
+                                 'records': dict(report.records), 'duplicates': dict(report.duplicates),
+                                 'elements_skipped': dict(report.elements_skipped.most_common()),
+                                 'skipped_examples': report.skipped_examples}
+        self.save()
+
+    def add_subject_times(self, name, subject_times):
+        '''
+        Adds the per-subject timings of a stage, {subject: (n_blocks, seconds)}
+        (see socialbrainapp.get_hardball_sessions), keeping the n_slowest subjects.
+        '''
+        slowest = sorted(subject_times.items(), key=lambda item: item[1][1], reverse=True)[:self.n_slowest]
+        self.report['subjects'][name] = {
+            'subjects': len(subject_times),
+            'blocks': int(sum(n_blocks for n_blocks, _ in subject_times.values())),
+            'seconds': sum(seconds for _, seconds in subject_times.values()),
+            'slowest': [{'subject': subject, 'blocks': int(n_blocks), 'seconds': seconds} for subject, (n_blocks, seconds) in slowest]}
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        self.report['updated'] = datetime.now().isoformat(timespec='seconds')
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as handle:
+            json.dump(self.report, handle, indent=1, default=_to_json)
+        os.replace(tmp_path, self.path)
+
+    def summary(self, n_subjects=5):
+        lines = []
+        for entry in self.report['stages']:
+            peak = f", {entry['peak_mb']:.1f}MB peak" if 'peak_mb' in entry else ''
+            rss = f", {entry['max_rss_mb']:.0f}MB max RSS" if entry['max_rss_mb'] is not None else ''
+            lines.append(f"{entry['stage']}: {entry['wall_s']:.2f}s ({entry['cpu_s']:.2f}s CPU{peak}{rss}), "
+                         f"{entry['rows_in']} -> {entry['rows_out']} rows" + (f", failed: {entry['error']}" if 'error' in entry else ''))
+        for name, subjects in self.report['subjects'].items():
+            lines.append(f"{name}: {subjects['subjects']} subjects, {subjects['blocks']} blocks in {subjects['seconds']:.2f}s, slowest:")
+            lines += [f"  {subject['subject']}: {subject['blocks']} blocks in {subject['seconds']:.3f}s"
+                      for subject in subjects['slowest'][:n_subjects]]
+        return '\n'.join(lines)
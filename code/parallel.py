@@ -0,0 +1,103 @@
+import pandas as pd, numpy as np, os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from socialbrainapp import RECORD_TYPES, concat_records, get_hardball_blocks, get_hardball_sessions
+from ingest import IngestReport, Withdrawals, ingest_json
+from store import partition_by_subject
+
+def _imap(func, tasks, workers):
+    # results come back in task order (each as soon as it and the ones before are done),
+    # so merging them is deterministic
+    if workers == 1 or len(tasks) <= 1:
+        yield from map(func, tasks)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        yield from pool.map(func, tasks)
+
+def _map(func, tasks, workers):
+    return list(_imap(func, tasks, workers))
+
+def _ingest_files(json_files, exclude_ids=None, fingerprints=None):
+    report = IngestReport()
+    withdrawals = Withdrawals()
+    dfs = ingest_json(json_files, report, on_element=withdrawals, exclude_ids=exclude_ids, fingerprints=fingerprints)
+    return dfs, report, withdrawals, fingerprints
+
+def parallel_ingest(json_files, report=None, withdrawals=None, workers=None, files_per_task=1, exclude_ids=None,
+                    fingerprints=None, stats=None):
+    '''
+    Parallel version of ingest.ingest_json: json files are parsed in a process pool,
+    files_per_task at a time, and merged in file order, so output matches the serial path
+    row for row. report and withdrawals (ingest.IngestReport / ingest.Withdrawals) are
+    updated with the counts and withdrawal ids of all files. Elements of subjects in
+    exclude_ids are skipped, and so are elements seen before if fingerprints (ingest.Fingerprints)
+    is given (see ingest.ingest_json); duplicates between tasks are dropped when merging.
+    stats (enrollment.EnrollmentStats) counts the records of each task once it is merged.
+    workers defaults to the number of CPUs; with workers=1 (or a single task) files are parsed serially.
+    '''
+    workers = os.cpu_count() if workers is None else workers
+    tasks = [json_files[i:i + files_per_task] for i in range(0, len(json_files), files_per_task)]
+    # a single task would run in this process with the fingerprints given, which cannot be merged into themselves
+    if workers == 1 or len(tasks) <= 1:
+        return ingest_json(json_files, report, on_element=withdrawals, exclude_ids=exclude_ids, fingerprints=fingerprints,
+                           stats=stats)
+
+    results = _imap(partial(_ingest_files, exclude_ids=exclude_ids, fingerprints=fingerprints), tasks, workers)
+
+    df_lists = {}
+    for dfs, task_report, task_withdrawals, task_fingerprints in results:
+        if fingerprints is not None:
+            dfs = fingerprints.merge(task_fingerprints, dfs, task_report)
+        if stats is not None:
+            stats.add_frames(dfs)
+        for record_type, df in dfs.items():
+            df_lists.setdefault(record_type, []).append(df)
+        if report is not None:
+            report.merge(task_report)
+        if withdrawals is not None:
+            withdrawals.merge(task_withdrawals)
+
+    return {record_type: concat_records(df_lists[record_type], record_type) for record_type in RECORD_TYPES if record_type in df_lists}
+
+def _call_timed(func, df):
+    subject_times = {}
+    return func(df, subject_times=subject_times), subject_times
+
+def map_subjects(func, df, subject_col=None, workers=None, subjects_per_task=None, subject_times=None):
+    '''
+    Runs func(df) -> DataFrame on groups of whole subjects in a process pool and concatenates the
+    results in sorted subject order. Subjects are given by subject_col (or the index), and func must
+    handle each subject independently (e.g. get_hardball_blocks / get_hardball_sessions with subject_col).
+    For input already sorted by subject, output matches func(df) row for row.
+    workers defaults to the number of CPUs; with workers=1, func(df) is called directly.
+    subjects_per_task defaults to splitting the subjects into 4 tasks per worker.
+    If subject_times is a dict, func is called with subject_times too and the
+    per-subject timings it records in each process are added to it.
+    '''
+    workers = os.cpu_count() if workers is None else workers
+    if workers == 1 or len(df) == 0:
+        return func(df) if subject_times is None else func(df, subject_times=subject_times)
+
+    subjects = partition_by_subject(df, subject_col)
+    if subjects_per_task is None:
+        subjects_per_task = max(1, int(np.ceil(len(subjects) / (workers * 4))))
+
+    # split rows sorted by subject into tasks of whole subjects
+    bounds = np.r_[subjects.offsets[:-1:subjects_per_task], subjects.offsets[-1]]
+    tasks = [subjects.data.iloc[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    if subject_times is None:
+        return pd.concat(_map(func, tasks, workers))
+
+    results = _map(partial(_call_timed, func), tasks, workers)
+    for _, task_times in results:
+        subject_times.update(task_times)
+    return pd.concat([result for result, _ in results])
+
+def get_hardball_blocks_and_sessions(df, subject_col=None, subject_times=None):
+    '''
+    get_hardball_blocks followed by get_hardball_sessions, for use with map_subjects.
+    '''
+    df = get_hardball_blocks(df.copy(), subject_col=subject_col)
+    return get_hardball_sessions(df, subject_col=subject_col, subject_times=subject_times)
@@ -0,0 +1,65 @@
+import pandas as pd, numpy as np
+
+from socialbrainapp import INSTRUMENTS
+
+def _get_spec(instrument, spec=None):
+    return INSTRUMENTS[instrument] if spec is None else spec
+
+def recode_responses(df, instrument, spec=None):
+    '''
+    Returns the coded responses (float32) of the SurveyAnswer and SurveyQuestion columns of a
+    questionnaire DF, with the answers and regular items (all others are reverse coded) of its spec (INSTRUMENTS[instrument]).
+    Each distinct answer is looked up once.
+    '''
+    spec = _get_spec(instrument, spec)
+    answers = df['SurveyAnswer'].astype('category')
+    # the extra NaN at the end is the code of missing answers (-1)
+    codes = np.array([spec['answers'].get(answer, np.nan) for answer in answers.cat.categories] + [np.nan], dtype='float32')
+    response = codes[answers.cat.codes.to_numpy()]
+
+    if spec['regular_items'] is not None:
+        reverse = ~df['SurveyQuestion'].isin(spec['regular_items']).to_numpy()
+        response[reverse] = spec['reverse_sum'] - response[reverse]
+    return pd.Series(response, index=df.index, name='Response')
+
+def score_survey(df, instrument, spec=None):
+    '''
+    Scores a questionnaire for all subjects (the index) at once.
+    Only subjects with n_items distinct items are scored, using their first response to each item.
+    Returns one row per subject with the items as <instrument>_<item> (without the attention check item),
+    <instrument>_Total (NaN if any item is missing) and, if the spec has an attention check item,
+    <instrument>_AttnCheck (1 if it was left unanswered, else 0, also for subjects without the item).
+    '''
+    spec = _get_spec(instrument, spec)
+    subjects = df.index.get_level_values(0)
+    questions = df['SurveyQuestion'].to_numpy()
+
+    # completed the survey
+    n_questions = pd.Series(questions, index=subjects).groupby(level=0).nunique()
+    completed = subjects.isin(n_questions.index[n_questions == spec['n_items']])
+
+    # first response of each subject to each item
+    items = pd.DataFrame({'SubjectID': subjects[completed], 'SurveyQuestion': questions[completed],
+                          'Response': recode_responses(df[completed], instrument, spec).to_numpy()})
+    items = items[~items.duplicated(['SubjectID', 'SurveyQuestion']).to_numpy()]
+
+    # long to wide
+    wide_df = items.set_index(['SubjectID', 'SurveyQuestion'])['Response'].unstack('SurveyQuestion')
+    wide_df.index.name = df.index.names[0]
+    if wide_df.empty:
+        # no subject completed the survey: keep the columns of the items 1..n_items
+        wide_df = wide_df.reindex(columns=range(1, spec['n_items'] + 1)).astype('float32')
+
+    attention_item = spec['attention_item']
+    attn_check = None
+    if attention_item is not None:
+        # subjects may have n_items distinct items without the attention check item
+        attention = items[items['SurveyQuestion'].to_numpy() == attention_item].set_index('SubjectID')['Response']
+        attn_check = attention.isna().reindex(wide_df.index, fill_value=False).astype(int).to_numpy()
+        wide_df = wide_df.drop(columns=attention_item, errors='ignore')
+
+    wide_df = wide_df.add_prefix(f'{instrument}_')
+    wide_df[f'{instrument}_Total'] = wide_df.sum(axis=1, skipna=False)
+    if attn_check is not None:
+        wide_df[f'{instrument}_AttnCheck'] = attn_check
+    return wide_df
@@ -1,373 +1,438 @@
-import pandas as pd, numpy as np
+import pandas as pd, numpy as np, time
 from datetime import datetime
-from itertools import combinations
+
+from store import partition_by_subject
 
 def get_withdrawn_ids(list1, list2):
-    matching = []
-    nonmatch1 = []
-    nonmatch2 = []
-    
-    for item in list1:
-        if item in list2:
-            matching.append(item)
-        else:
-            nonmatch1.append(item)
-            
-    for item in list2:
-        if item not in list1:
-            nonmatch2.append(item)
-            
-    return list(np.unique(matching)), list(np.unique(nonmatch1)), list(np.unique(nonmatch2))
-
-def get_hardball_blocks(df):
-    '''
-    DF is subject specific and should be contain the following columns:
-    ['OpponentNum','Condition','Year','Month','Day','Hour','Minute','Second']
-    '''
-
-    # Create a new column "BlockID" filled with NaNs
-    df['BlockID'] = np.nan
-
-    # Iterate over rows
-    curr_block_id = 0
-    for i, row in df.iterrows():
-
-        # Check if the current row starts a new session
-        if row['OpponentNum'] == 1:
-
-            # Iterate over the next 30 rows
-            this_block_first_opp_count = []
-            this_block_first_idx_count = []
-            this_block_first_cond_count = []
-            end_current_block = False
-            for j_idx, j in enumerate(range(i, i+30)):
-                # Check if the row exists
-                if j < len(df):
-
-                    # check that OpponentNum is counting up
-                    if int(j_idx+1) == int(df.loc[j,'OpponentNum']):
-                        this_block_first_idx_count += [j]
-                        this_block_first_opp_count += [df.loc[j,'OpponentNum']]
-                        this_block_first_cond_count += [df.loc[j,'Condition']]
-                    else:
-                        end_current_block = True
-                    
-                    if len(this_block_first_idx_count) == 30:
-                        end_current_block = True
-                    
-                    if end_current_block:
-                        if len(this_block_first_idx_count) == 30 and np.sum(this_block_first_opp_count)==465 and np.sum([1 for x in this_block_first_cond_count if x==this_block_first_cond_count[0]]):
-                            curr_block_id += 1
-                            df.loc[this_block_first_idx_count,'BlockID'] = curr_block_id
+    set1, set2 = set(list1), set(list2)
+    return sorted(set1 & set2), sorted(set1 - set2), sorted(set2 - set1)
+
+# Withdrawal status of subjects that withdrew from the study (Withdrawal) and/or withdrew
+# their data (WithdrawalShare): WithdrawType, WithdrawAll, WithdrawStudy, WithdrawData
+WITHDRAW_COLUMNS = ['WithdrawType', 'WithdrawAll', 'WithdrawStudy', 'WithdrawData']
+WITHDRAW_STATUS = {
+    'All': ['FromStudy', 1.0, 0.0, 0.0],
+    'Study': ['FromStudy', 0.0, 1.0, 0.0],
+    'Data': ['Data', 0.0, 0.0, 1.0],
+    'NA': ['NA', 0.0, 0.0, 0.0],
+}
+
+def get_withdrawal_status(withdraw_ids, withdrawshare_ids):
+    '''
+    Returns the withdrawal status (WITHDRAW_COLUMNS) of every withdrawn subject, indexed by UserId.
+    Subjects not in the table have not withdrawn (WITHDRAW_STATUS['NA']).
+    '''
+    groups = dict(zip(['All', 'Study', 'Data'], get_withdrawn_ids(withdraw_ids, withdrawshare_ids)))
+    rows = [WITHDRAW_STATUS[status] for status, ids in groups.items() for _ in ids]
+    index = pd.Index([subj_id for ids in groups.values() for subj_id in ids], name='UserId')
+    status_df = pd.DataFrame(rows, index=index, columns=WITHDRAW_COLUMNS)
+    return status_df.astype({col: float for col in WITHDRAW_COLUMNS[1:]}).sort_index()
+
+def get_withdrawn_data_ids(status_df, columns=('WithdrawData',)):
+    '''
+    Returns the set of subjects with any of the given withdrawal columns set,
+    by default the subjects that withdrew their data (e.g. to exclude them during ingestion).
+    '''
+    return set(status_df.index[status_df[list(columns)].eq(1).any(axis=1)])
+
+def add_withdrawal_status(df, status_df, subject_col=None):
+    '''
+    Returns a copy of df with the withdrawal status columns of its subjects (subject_col or the index),
+    looked up in the table from get_withdrawal_status all at once.
+    '''
+    df = df.copy()
+    subj_ids = df[subject_col] if subject_col is not None else df.index.get_level_values(0)
+    subj_status = status_df.reindex(subj_ids.to_numpy())
+    for col, default in zip(WITHDRAW_COLUMNS, WITHDRAW_STATUS['NA']):
+        df[col] = subj_status[col].fillna(default).to_numpy()
     return df
 
-def get_hardball_sessions(df):
-    '''
-    DF is subject specific and should be contain the following columns:
-    ['OpponentNum','Condition','BlockID','Year','Month','Day','Hour','Minute','Second']
-    '''
-    df = df[~np.isnan(df.BlockID)]
-
-    # create a dictionary that groups the block_id values by condition_id
-    cond_block_dict = {}
-    for cond_id, block_ids in df.groupby("Condition")["BlockID"]:
-        cond_block_dict[cond_id] = set(block_ids)
-
-    # create a list of all possible pairs of condition ids
-    cond_pairs = list(combinations(cond_block_dict.keys(), 2))
-
-    # create a dictionary to store the time differences for each pair of block_ids
-    time_diff_dict = {}
-
-    # loop through all pairs of condition ids
-    for cond_pair in cond_pairs:
-        # get the block_ids for each condition id
-        block_ids1 = cond_block_dict[cond_pair[0]]
-        block_ids2 = cond_block_dict[cond_pair[1]]
-        
-        # create a list of all possible pairs of block_ids
-        block_pairs = list(combinations(block_ids1.union(block_ids2), 2))
-        
-        # loop through all pairs of block_ids
-        for block_pair in block_pairs:
-            # get the rows corresponding to the two block_ids
-            rows1 = df[(df["BlockID"] == int(block_pair[0]))]
-            rows2 = df[(df["BlockID"] == int(block_pair[1]))]
-            
-            # get the earliest and latest timestamps for the two blocks
-            row2_times = rows2[["Year", "Month", "Day", "Hour", "Minute", "Second"]].apply(lambda x: pd.Timestamp(*x), axis=1)
-            row1_times = rows1[["Year", "Month", "Day", "Hour", "Minute", "Second"]].apply(lambda x: pd.Timestamp(*x), axis=1)
-
-            if row1_times.mean() > row2_times.mean(): # row 1 later
-                earliest_timestamp = min(row2_times)
-                latest_timestamp = max(row1_times)
-            elif row1_times.mean() < row2_times.mean(): # row 1 earlier
-                earliest_timestamp = min(row1_times)
-                latest_timestamp = max(row2_times)
-            
-            # calculate the time difference between the two blocks
-            time_diff = (latest_timestamp - earliest_timestamp).total_seconds()
-            
-            # store the time difference in the dictionary
-            time_diff_dict[block_pair] = time_diff
-
-    # create a list of all possible pairs of block_ids
-    block_pairs = list(combinations(set(df["BlockID"]), 2))
-
-    # create a dictionary to store the session_id for each block_id
-    session_id_dict = {}
-    session_count = 0
-
-    # loop through all pairs of block_ids
-    for block_pair in block_pairs:
-        # get the condition ids for each block_id
-        cond_ids1 = set(df[df["BlockID"] == block_pair[0]]["Condition"])
-        cond_ids2 = set(df[df["BlockID"] == block_pair[1]]["Condition"])
-        
-        # check if the two block_ids correspond to two unique condition_ids
-        if len(cond_ids1) == 1 and len(cond_ids2) == 1 and len(cond_ids1.union(cond_ids2)) == 2:
-            # calculate the time difference between the two blocks
-            time_diff = time_diff_dict[block_pair]
-            
-            # get dict of time_diff for other pairs
-            other_time_diffs = {i:time_diff_dict[i] for i in time_diff_dict if ((block_pair[0] in i) or (block_pair[1] in i)) and (i!=block_pair)}
-
-            # check if the time difference is minimal
-            if other_time_diffs:
-                if time_diff < min([time_diff_dict[b] for b in other_time_diffs]):
-                    session_count += 1
-                    # assign a new session_id to the two block_ids
-                    session_id_dict[np.round(block_pair[0],1)] = session_count
-                    session_id_dict[np.round(block_pair[1],1)] = session_count
-            else:
+HARDBALL_BLOCK_LEN = 30 # opponents per Hardball block
+HARDBALL_MIN_TRIALS = 60 # trials of a completed Hardball
+
+def get_hardball_blocks(df, subject_col=None):
+    '''
+    DF should be sorted in time and contain the following columns:
+    ['OpponentNum','Condition']
+
+    A block is a run of 30 consecutive rows with OpponentNum counting up 1..30.
+    Blocks are numbered 1, 2, ... in row order and written to a new "BlockID" column.
+    DF is subject specific, unless subject_col names the column holding the subject id,
+    in which case blocks of all subjects are found in one pass and numbered within each subject.
+    '''
+    opp_num = pd.to_numeric(df['OpponentNum'], errors='coerce').to_numpy(dtype=float)
+    n_rows = len(opp_num)
+
+    # work on rows grouped by subject (stable, so each subject keeps its row order)
+    if subject_col is None:
+        order = np.arange(n_rows)
+        subj_codes = np.zeros(n_rows, dtype=int)
+    else:
+        subj_codes = pd.factorize(df[subject_col])[0]
+        order = np.argsort(subj_codes, kind='stable')
+        subj_codes = subj_codes[order]
+        opp_num = opp_num[order]
+
+    block_ids = np.full(n_rows, np.nan)
+    if n_rows >= HARDBALL_BLOCK_LEN:
+        # a run is broken wherever OpponentNum does not count up by one or the subject changes
+        breaks = (np.diff(opp_num) != 1) | (np.diff(subj_codes) != 0)
+        n_breaks = np.concatenate([[0], np.cumsum(breaks)])
+
+        # blocks start at OpponentNum 1 with no break over the next 30 rows (so 1..30, summing to 465)
+        starts = np.flatnonzero(opp_num[:n_rows - HARDBALL_BLOCK_LEN + 1] == 1)
+        starts = starts[n_breaks[starts + HARDBALL_BLOCK_LEN - 1] == n_breaks[starts]]
+
+        # number blocks within each subject
+        start_codes = subj_codes[starts]
+        block_nums = np.arange(1, len(starts) + 1) - np.searchsorted(start_codes, start_codes)
+
+        block_rows = (starts[:, None] + np.arange(HARDBALL_BLOCK_LEN)).ravel()
+        block_ids[order[block_rows]] = np.repeat(block_nums, HARDBALL_BLOCK_LEN)
+
+    df['BlockID'] = block_ids
+    return df
+
+def _timestamp_seconds(df):
+    # whole seconds since epoch (the resolution of the Year..Second columns)
+    return df['Timestamp'].to_numpy(dtype='datetime64[s]').astype(np.int64)
+
+def _closest_blocks(starts, ends, means):
+    '''
+    For blocks with first/last/mean timestamps, returns the closest other block of each block
+    (-1 if there is none) and whether it is strictly closer than all other blocks.
+    The time difference of two blocks runs from the start of the earlier block (by mean time)
+    to the end of the later block.
+    '''
+    n_blocks = len(starts)
+    order = np.argsort(means, kind='stable')
+    starts, ends = starts[order], ends[order]
+
+    # candidates: the two earlier blocks that start latest and the two later blocks that end first
+    earlier = []
+    top = []
+    for k in range(n_blocks):
+        earlier.append(top)
+        top = sorted(top + [(-starts[k], k)])[:2]
+    later = [None] * n_blocks
+    top = []
+    for k in reversed(range(n_blocks)):
+        later[k] = top
+        top = sorted(top + [(ends[k], k)])[:2]
+
+    closest = np.full(n_blocks, -1)
+    strict = np.zeros(n_blocks, dtype=bool)
+    for k in range(n_blocks):
+        diffs = sorted([(ends[k] - starts[c], c) for _, c in earlier[k]] + [(ends[c] - starts[k], c) for _, c in later[k]])
+        if diffs:
+            closest[order[k]] = order[diffs[0][1]]
+            strict[order[k]] = len(diffs) == 1 or diffs[0][0] < diffs[1][0]
+    return closest, strict
+
+def get_hardball_sessions(df, subject_col=None, subject_times=None):
+    '''
+    DF should contain the following columns:
+    ['OpponentNum','Condition','BlockID','Timestamp']
+
+    Two blocks with different conditions form a session if they are closer in time to each other
+    than to any other block. Sessions are numbered 1, 2, ... in BlockID order and written to a new
+    "SessionID" column; rows without a BlockID are dropped.
+    DF is subject specific, unless subject_col names the column holding the subject id,
+    in which case sessions of all subjects are found in one pass and numbered within each subject.
+    If subject_times is a dict, the number of blocks and the seconds spent pairing them are
+    added to it per subject, as {subject: (n_blocks, seconds)}.
+    '''
+    df = df[~np.isnan(df.BlockID)].copy()
+
+    # summarise each block once
+    subj_ids = df[subject_col].to_numpy() if subject_col is not None else np.zeros(len(df), dtype=int)
+    blocks = pd.DataFrame({'SubjectID': subj_ids, 'BlockID': df['BlockID'].to_numpy(),
+                           'Condition': df['Condition'].to_numpy(), 'Time': _timestamp_seconds(df)})
+    blocks = blocks.groupby(['SubjectID', 'BlockID']).agg(Start=('Time', 'min'), End=('Time', 'max'), Mean=('Time', 'mean'),
+                                                          NConditions=('Condition', 'nunique'), Condition=('Condition', 'first'))
+
+    # pair mutually closest blocks within each subject
+    session_ids = np.full(len(blocks), np.nan)
+    subj_codes = pd.factorize(blocks.index.get_level_values('SubjectID'))[0]
+    # no bounds (and no subject times) without blocks
+    subj_bounds = np.r_[0, np.flatnonzero(np.diff(subj_codes)) + 1, len(subj_codes)] if len(blocks) else np.zeros(1, dtype=int)
+    for lo, hi in zip(subj_bounds[:-1], subj_bounds[1:]):
+        start_time = time.perf_counter()
+        subj_blocks = blocks.iloc[lo:hi]
+        closest, strict = _closest_blocks(subj_blocks['Start'].to_numpy(), subj_blocks['End'].to_numpy(), subj_blocks['Mean'].to_numpy())
+        single_cond = subj_blocks['NConditions'].to_numpy() == 1
+        conds = subj_blocks['Condition'].to_numpy()
+
+        # blocks are sorted by BlockID, so sessions are numbered in BlockID order
+        session_count = 0
+        for i, j in enumerate(closest):
+            if i < j and closest[j] == i and strict[i] and strict[j] and single_cond[i] and single_cond[j] and conds[i] != conds[j]:
                 session_count += 1
-                # assign a new session_id to the two block_ids
-                session_id_dict[np.round(block_pair[0],1)] = session_count
-                session_id_dict[np.round(block_pair[1],1)] = session_count
-                
-    #create a new column called session_id in the dataframe
-    df['SessionID'] = df['BlockID'].map(session_id_dict)
+                session_ids[lo + i] = session_ids[lo + j] = session_count
+
+        if subject_times is not None:
+            subject_times[blocks.index[lo][0]] = (hi - lo, time.perf_counter() - start_time)
+
+    #create a new column called SessionID in the dataframe
+    session_ids = pd.Series(session_ids, index=blocks.index)
+    df['SessionID'] = session_ids.reindex(pd.MultiIndex.from_arrays([subj_ids, df['BlockID'].to_numpy()])).to_numpy()
+    if not df['SessionID'].isna().any():
+        df['SessionID'] = df['SessionID'].astype(int)
 
     return df
 
+def get_perceived_control(hardball_df, ratings_df, subject_col='index'):
+    '''
+    Attaches the subjective ratings of HardballSubjectiveRatings to the Hardball trials (with SessionID)
+    of the same subject, TeamName and session, adding the columns PerceivedControl and RateDateTime.
+    Both DFs should contain the following columns:
+    [subject_col,'TeamName','Timestamp'] plus 'SessionID' (hardball_df) or 'Rate' (ratings_df)
+
+    The session of a rating is the session of the subject's latest trial before it (at the resolution
+    of seconds). Ratings are taken in order: a rating goes to PerceivedControl if there is none yet,
+    or if the rating already there is closer in time to the last trial of the team in that session;
+    otherwise it goes to PerceivedControl2 (and Rate2DateTimeTime).
+    '''
+    df = hardball_df.copy()
+    trial_times = df['Timestamp'].dt.floor('s').to_numpy()
+    trial_keys = pd.DataFrame({'SubjectID': df[subject_col].to_numpy(), 'TeamName': df['TeamName'].to_numpy(),
+                               'SessionID': df['SessionID'].to_numpy(dtype=float), 'Time': trial_times})
+
+    # as-of join of each rating on the latest earlier trial of the subject
+    # (trials in reverse order, so that of several trials at that time the first one is used)
+    trials = trial_keys[['SubjectID', 'Time', 'SessionID']].iloc[::-1].sort_values('Time', kind='stable')
+    ratings = pd.DataFrame({'SubjectID': ratings_df[subject_col].to_numpy(), 'TeamName': ratings_df['TeamName'].to_numpy(),
+                            'Rate': ratings_df['Rate'].to_numpy(), 'Time': ratings_df['Timestamp'].dt.floor('s').to_numpy(),
+                            'Order': np.arange(len(ratings_df))})
+    ratings = pd.merge_asof(ratings.sort_values('Time', kind='stable'), trials, on='Time', by='SubjectID',
+                            allow_exact_matches=False).sort_values('Order')
+
+    # last trial of each subject, team and session
+    last_trial_times = trial_keys.groupby(['SubjectID', 'TeamName', 'SessionID'], sort=False)['Time'].last()
+    last_trial_times = dict(zip(last_trial_times.index, last_trial_times))
+
+    # go through the ratings in order to resolve several ratings of the same team and session
+    rates = {}
+    spilled = False
+    for subj_id, team_id, rate, rate_time, sess_id in ratings[['SubjectID', 'TeamName', 'Rate', 'Time', 'SessionID']].itertuples(index=False):
+        key = (subj_id, team_id, sess_id)
+        if np.isnan(sess_id) or key not in last_trial_times:
+            continue
+
+        key_rates = rates.setdefault(key, [np.nan, pd.NaT, np.nan, pd.NaT])
+        behav_time = last_trial_times[key]
+        if pd.isna(key_rates[0]) or abs(key_rates[1] - behav_time) < abs(rate_time - behav_time):
+            key_rates[0:2] = [rate, rate_time]
+        else:
+            key_rates[2:4] = [rate, rate_time]
+            spilled = True
+
+    # write the ratings to all trials of their team and session
+    columns = ['PerceivedControl', 'RateDateTime', 'PerceivedControl2', 'Rate2DateTimeTime']
+    rates = pd.DataFrame(list(rates.values()), columns=columns,
+                         index=pd.MultiIndex.from_tuples(list(rates), names=['SubjectID', 'TeamName', 'SessionID']))
+    rates = rates.astype({col: float if col.startswith('Perceived') else 'datetime64[ns]' for col in columns})
+    rates = rates.reindex(pd.MultiIndex.from_frame(trial_keys[['SubjectID', 'TeamName', 'SessionID']]))
+    for col in columns if spilled else columns[:2]:
+        df[col] = rates[col].to_numpy()
+
+    return df
+
+# Column layout of every record type. The per-element get_* functions and the
+# batch parser (parse_elements) share these so both produce the same frames.
+TIME_COLUMNS = ['Year', 'Month', 'Day', 'Hour', 'Minute', 'Second']
+SURVEY_COLUMNS = ['SurveyName', 'SurveyQuestion', 'SurveyAnswer', 'Response', 'Question'] + TIME_COLUMNS
+CHAR_ROLES = ['First', 'Second', 'Assistant', 'Newcomb', 'Hayworth', 'Neutral']
+
+RECORD_COLUMNS = {
+    'Demographics': ['Age', 'Gender', 'Race',
+                     'Ethnicity', 'Education',
+                     'Income', 'Zip',
+                     'Withdrawal', 'HasPreviouslyInstalled'] + TIME_COLUMNS,
+    'Hardball': ['Condition', 'OpponentNum',
+                 'Game', 'TeamName',
+                 'Opponent', 'Offer',
+                 'Response', 'Accept', 'Reject', 'Reward'] + TIME_COLUMNS,
+    'HardballSubjectiveRatings': ['Game', 'TeamName', 'Rate'] + TIME_COLUMNS,
+    'OCI': SURVEY_COLUMNS,
+    'SDS': SURVEY_COLUMNS,
+    'LSAS': SURVEY_COLUMNS,
+    'Journey_decisions': ['decision_num', 'decision', 'Datetime'] + TIME_COLUMNS,
+    'Journey_memory': ['question_num', 'answer', 'Datetime'] + TIME_COLUMNS,
+    'Journey_dots': [f'dots_{char}_{dim}' for char in CHAR_ROLES for dim in ['affil', 'power']] + ['Datetime'] + TIME_COLUMNS,
+    'Journey_characters': [f'{char}_{field}' for char in CHAR_ROLES for field in ['name', 'gender', 'image']] + ['Datetime'] + TIME_COLUMNS,
+}
+RECORD_TYPES = list(RECORD_COLUMNS)
+
+# Fields taken from the json elements. The time columns are derived from the
+# "Timestamp" of the elements, which is parsed once for all records of a type.
+RECORD_FIELDS = {record_type: [col for col in columns if col not in TIME_COLUMNS] for record_type, columns in RECORD_COLUMNS.items()}
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Declared dtypes of the parsed records ('str': strings, kept as objects).
+# Every record type also has a datetime64 "Timestamp" column.
+TIME_SCHEMA = {'Year': 'int16', 'Month': 'int8', 'Day': 'int8', 'Hour': 'int8', 'Minute': 'int8', 'Second': 'int8'}
+SURVEY_SCHEMA = {'SurveyName': 'category', 'SurveyQuestion': 'int8', 'SurveyAnswer': 'category',
+                 'Response': 'float32', 'Question': 'category', **TIME_SCHEMA}
+JOURNEY_SCHEMA = {'Datetime': 'str', **TIME_SCHEMA}
+
+RECORD_SCHEMAS = {
+    'Demographics': {'Age': 'category', 'Gender': 'category', 'Race': 'category',
+                     'Ethnicity': 'category', 'Education': 'category',
+                     'Income': 'category', 'Zip': 'str',
+                     'Withdrawal': 'category', 'HasPreviouslyInstalled': 'category', **TIME_SCHEMA},
+    'Hardball': {'Condition': 'category', 'OpponentNum': 'int8',
+                 'Game': 'category', 'TeamName': 'category',
+                 'Opponent': 'category', 'Offer': 'float64',
+                 'Response': 'category', 'Accept': 'int8', 'Reject': 'int8', 'Reward': 'float64', **TIME_SCHEMA},
+    'HardballSubjectiveRatings': {'Game': 'category', 'TeamName': 'category', 'Rate': 'numeric', **TIME_SCHEMA},
+    'OCI': SURVEY_SCHEMA,
+    'SDS': SURVEY_SCHEMA,
+    'LSAS': SURVEY_SCHEMA,
+    'Journey_decisions': {'decision_num': 'category', 'decision': 'category', **JOURNEY_SCHEMA},
+    'Journey_memory': {'question_num': 'category', 'answer': 'category', **JOURNEY_SCHEMA},
+    'Journey_dots': {**{col: 'numeric' for col in RECORD_FIELDS['Journey_dots'][:-1]}, **JOURNEY_SCHEMA},
+    'Journey_characters': {**{col: 'category' for col in RECORD_FIELDS['Journey_characters'][:-1]}, **JOURNEY_SCHEMA},
+}
+
+# Response coding of the questionnaires (unknown answers are left as NaN)
+OCI_ANSWERS = {'Not at all': 0, 'A little': 1, 'Moderately': 2, 'A lot': 3, 'Extremely': 4, '': np.nan}
+SDS_ANSWERS = {'A little of the time': 1, 'Some of the time': 2, 'Good part of the time': 3, 'Most of the time': 4, '': np.nan}
+SDS_REGULAR_ITEMS = {1, 3, 4, 7, 8, 9, 10, 13, 15, 20} # all other items are reverse coded
+LSAS_ANSWERS = {'Never (0%)': 0, 'Occasionally (1-33%)': 1, 'Often (34-66%)': 2, 'Usually (67-100%)': 3, '': np.nan}
+
+# Scoring of the questionnaires (see scoring.py): response coding, regular items (all other
+# items are reverse coded, scored reverse_sum - response; None if no item is reverse coded),
+# attention check item (left out of the items and total) and number of distinct items of a completed survey
+INSTRUMENTS = {
+    'OCI': {'answers': OCI_ANSWERS, 'regular_items': None, 'reverse_sum': None, 'attention_item': 15, 'n_items': 19},
+    'SDS': {'answers': SDS_ANSWERS, 'regular_items': SDS_REGULAR_ITEMS, 'reverse_sum': 5, 'attention_item': 16, 'n_items': 21},
+    'LSAS': {'answers': LSAS_ANSWERS, 'regular_items': None, 'reverse_sum': None, 'attention_item': None, 'n_items': 24},
+}
+
+# Rows hold the record fields followed by the unparsed timestamp.
+def _timestamp_fields(timestamp):
+    tmp_date = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    return [tmp_date.year, tmp_date.month, tmp_date.day, tmp_date.hour, tmp_date.minute, tmp_date.second]
+
+def _demographics_row(element):
+    return [element[col] for col in RECORD_FIELDS['Demographics']] + [element['Timestamp']]
+
+def _survey_row(element, response):
+    return [element['SurveyName'], element['SurveyQuestion'], element['SurveyAnswer'],
+            response, element['Que'], element['Timestamp']]
+
+def _survey_response(instrument, element):
+    spec = INSTRUMENTS[instrument]
+    response = spec['answers'].get(element['SurveyAnswer'], np.nan)
+    if spec['regular_items'] is not None and element['SurveyQuestion'] not in spec['regular_items']: # reverse code
+        response = spec['reverse_sum'] - response
+    return response
+
+def _oci_row(element):
+    return _survey_row(element, _survey_response('OCI', element))
+
+def _sds_row(element):
+    return _survey_row(element, _survey_response('SDS', element))
+
+def _lsas_row(element):
+    return _survey_row(element, _survey_response('LSAS', element))
+
+def _hardball_row(element):
+    offer = float(element['Offer'].strip('$'))
+
+    # recode responses with 1s and 0s and add reward if accept
+    if element['Response'] == 'Accept':
+        accept, reject, reward = 1, 0, offer
+    else:
+        accept, reject, reward = 0, 1, 0.0
+
+    return [element['Condition'], element['OpponentNum'],
+            element['Game'], element['TeamName'],
+            element['Opponent'], offer,
+            element['Response'], accept, reject, reward, element['Timestamp']]
+
+def _hardball_ratings_row(element):
+    return [element['Game'], element['TeamName'], element['Rate'], element['Timestamp']]
+
+def _journey_task(element):
+    '''
+    Returns the task name of Journey elements we keep, None for all other trials.
+    Task data takes precedence over dots data, which takes precedence over task version info.
+    '''
+    if 'Task' in element:
+        task = element['Task']
+        if 'Decision' in task:
+            return 'decisions'
+        elif ('Attention' in task) or ('Memory' in task):
+            return 'memory'
+    elif 'CharFirstX' in element:
+        return 'dots'
+    return 'characters' if element.get('SlideNum') == 1 else None
+
+def _journey_row(element):
+    '''
+    Returns (task_name, row) for Journey elements we keep, None for all other trials.
+    '''
+    task_name = _journey_task(element)
+    if task_name == 'decisions':
+        values = np.array([element['Task'], element['JourneyAnswer']]).tolist()
+    elif task_name == 'memory':
+        values = np.array([element['Task'], element['Option']]).tolist()
+    elif task_name == 'dots':
+        values = np.array([[element['Char'+role+'X'], element['Char'+role+'Y']] for role in CHAR_ROLES]).flatten().tolist()
+    elif task_name == 'characters':
+        characters = []
+        for role in CHAR_ROLES:
+            name = element['CharName' + role]
+            img = element['CharImage' + role].split('/')[-1]
+            gender = element['CharGender' + role]
+            characters.append([name, gender, img])
+        values = np.array(characters).flatten().tolist()
+    else:
+        return None
+
+    # the Datetime column keeps the timestamp as text
+    return task_name, values + [element['Timestamp'], element['Timestamp']]
+
+def _record_frame(record_type, user_id, row):
+    row = row[:-1] + _timestamp_fields(row[-1])
+    return pd.DataFrame([row], index=[user_id], columns=RECORD_COLUMNS[record_type], dtype=object)
+
 def get_demographics(element):
     assert type(element) is dict, 'Input should be dictionary'
     assert ('Age' in element.keys()), '"Age" should exist in dictionary'
 
-    demo_df = pd.DataFrame(index=[element['UserId']], 
-                           columns=['Age','Gender','Race',
-                                    'Ethnicity','Education',
-                                    'Income','Zip',
-                                    'Withdrawal','HasPreviouslyInstalled',
-                                    'Year', 'Month','Day',
-                                    'Hour','Minute','Second'])
-
-    demo_df.at[element['UserId'], 'Age'] = element['Age']
-    demo_df.at[element['UserId'], 'Gender'] = element['Gender']
-    demo_df.at[element['UserId'], 'Race'] = element['Race']
-    demo_df.at[element['UserId'], 'Ethnicity'] = element['Ethnicity']
-    demo_df.at[element['UserId'], 'Education'] = element['Education']
-    demo_df.at[element['UserId'], 'Income'] = element['Income']
-    demo_df.at[element['UserId'], 'Zip'] = element['Zip']
-    demo_df.at[element['UserId'], 'Withdrawal'] = element['Withdrawal']
-    demo_df.at[element['UserId'], 'HasPreviouslyInstalled'] = element['HasPreviouslyInstalled']
-
-    # convert timestamp
-    tmp_date = datetime.strptime(element['Timestamp'], "%Y-%m-%d %H:%M:%S.%f")
-    demo_df.at[element['UserId'], 'Year'] = int(tmp_date.year)
-    demo_df.at[element['UserId'], 'Month'] = int(tmp_date.month)
-    demo_df.at[element['UserId'], 'Day'] = int(tmp_date.day)
-    demo_df.at[element['UserId'], 'Hour'] = int(tmp_date.hour)
-    demo_df.at[element['UserId'], 'Minute'] = int(tmp_date.minute)
-    demo_df.at[element['UserId'], 'Second'] = int(tmp_date.second)
-
-    return demo_df
+    return _record_frame('Demographics', element['UserId'], _demographics_row(element))
 
 def get_oci(element):
     assert type(element) is dict, 'Input should be dictionary'
     assert ('SurveyName' in element.keys()), '"SurveyName" should exist in dictionary'
     assert (element['SurveyName'] == 'OCI'), '"SurveyName" should be "OCI"'
 
-    oci_df = pd.DataFrame(index=[element['UserId']], 
-                          columns=['SurveyName',
-                                   'SurveyQuestion',
-                                   'SurveyAnswer',
-                                   'Response',
-                                   'Question',
-                                   'Year', 'Month','Day',
-                                   'Hour','Minute','Second'])
-
-    oci_df.at[element['UserId'], 'SurveyName'] = element['SurveyName']
-    oci_df.at[element['UserId'], 'SurveyQuestion'] = element['SurveyQuestion']
-    oci_df.at[element['UserId'], 'SurveyAnswer'] = element['SurveyAnswer']
-    
-    # recode responses
-    if element['SurveyAnswer'] == 'Not at all':
-        oci_df.at[element['UserId'], 'Response'] = 0
-    elif element['SurveyAnswer'] == 'A little':
-        oci_df.at[element['UserId'], 'Response'] = 1
-    elif element['SurveyAnswer'] == 'Moderately':
-        oci_df.at[element['UserId'], 'Response'] = 2
-    elif element['SurveyAnswer'] == 'A lot':
-        oci_df.at[element['UserId'], 'Response'] = 3
-    elif element['SurveyAnswer'] == 'Extremely':
-        oci_df.at[element['UserId'], 'Response'] = 4
-    elif element['SurveyAnswer'] == '':
-        oci_df.at[element['UserId'], 'Response'] = np.nan
-    
-    oci_df.at[element['UserId'], 'Question'] = element['Que']
-
-    # convert timestamp
-    tmp_date = datetime.strptime(element['Timestamp'], "%Y-%m-%d %H:%M:%S.%f")
-    oci_df.at[element['UserId'], 'Year'] = int(tmp_date.year)
-    oci_df.at[element['UserId'], 'Month'] = int(tmp_date.month)
-    oci_df.at[element['UserId'], 'Day'] = int(tmp_date.day)
-    oci_df.at[element['UserId'], 'Hour'] = int(tmp_date.hour)
-    oci_df.at[element['UserId'], 'Minute'] = int(tmp_date.minute)
-    oci_df.at[element['UserId'], 'Second'] = int(tmp_date.second)
-
-    return oci_df
+    return _record_frame('OCI', element['UserId'], _oci_row(element))
 
 def get_sds(element):
     assert type(element) is dict, 'Input should be dictionary'
     assert ('SurveyName' in element.keys()), '"SurveyName" should exist in dictionary'
     assert (element['SurveyName'] == 'SDS'), '"SurveyName" should be "SDS"'
 
-    sds_df = pd.DataFrame(index=[element['UserId']], 
-                          columns=['SurveyName',
-                                   'SurveyQuestion',
-                                   'SurveyAnswer',
-                                   'Response',
-                                   'Question',
-                                   'Year', 'Month','Day',
-                                   'Hour','Minute','Second'])
-
-    sds_df.at[element['UserId'], 'SurveyName'] = element['SurveyName']
-    sds_df.at[element['UserId'], 'SurveyQuestion'] = element['SurveyQuestion']
-    sds_df.at[element['UserId'], 'SurveyAnswer'] = element['SurveyAnswer']
-
-    # recode responses
-    if element['SurveyQuestion'] in [1, 3, 4, 7, 8, 9, 10, 13, 15, 20]: # regular code
-        if element['SurveyAnswer'] == 'A little of the time':
-            sds_df.at[element['UserId'], 'Response'] = 1
-        elif element['SurveyAnswer'] == 'Some of the time':
-            sds_df.at[element['UserId'], 'Response'] = 2
-        elif element['SurveyAnswer'] == 'Good part of the time':
-            sds_df.at[element['UserId'], 'Response'] = 3
-        elif element['SurveyAnswer'] == 'Most of the time':
-            sds_df.at[element['UserId'], 'Response'] = 4
-        elif element['SurveyAnswer'] == '':
-            sds_df.at[element['UserId'], 'Response'] = np.nan
-    else: # reverse code
-        if element['SurveyAnswer'] == 'A little of the time':
-            sds_df.at[element['UserId'], 'Response'] = 4
-        elif element['SurveyAnswer'] == 'Some of the time':
-            sds_df.at[element['UserId'], 'Response'] = 3
-        elif element['SurveyAnswer'] == 'Good part of the time':
-            sds_df.at[element['UserId'], 'Response'] = 2
-        elif element['SurveyAnswer'] == 'Most of the time':
-            sds_df.at[element['UserId'], 'Response'] = 1
-        elif element['SurveyAnswer'] == '':
-            sds_df.at[element['UserId'], 'Response'] = np.nan
-    
-    sds_df.at[element['UserId'], 'Question'] = element['Que']
-
-    # convert timestamp
-    tmp_date = datetime.strptime(element['Timestamp'], "%Y-%m-%d %H:%M:%S.%f")
-    sds_df.at[element['UserId'], 'Year'] = int(tmp_date.year)
-    sds_df.at[element['UserId'], 'Month'] = int(tmp_date.month)
-    sds_df.at[element['UserId'], 'Day'] = int(tmp_date.day)
-    sds_df.at[element['UserId'], 'Hour'] = int(tmp_date.hour)
-    sds_df.at[element['UserId'], 'Minute'] = int(tmp_date.minute)
-    sds_df.at[element['UserId'], 'Second'] = int(tmp_date.second)
-    
-    return sds_df
+    return _record_frame('SDS', element['UserId'], _sds_row(element))
 
 def get_lsas(element):
     assert type(element) is dict, 'Input should be dictionary'
     assert ('SurveyName' in element.keys()), '"SurveyName" should exist in dictionary'
     assert (element['SurveyName'] == 'LSAS'), '"SurveyName" should be "LSAS"'
 
-    lsas_df = pd.DataFrame(index=[element['UserId']], 
-                        columns=['SurveyName',
-                                 'SurveyQuestion',
-                                 'SurveyAnswer',
-                                 'Response',
-                                 'Question',
-                                 'Year', 'Month','Day',
-                                 'Hour','Minute','Second'])
-
-    lsas_df.at[element['UserId'], 'SurveyName'] = element['SurveyName']
-    lsas_df.at[element['UserId'], 'SurveyQuestion'] = element['SurveyQuestion']
-    lsas_df.at[element['UserId'], 'SurveyAnswer'] = element['SurveyAnswer']
-    
-    # recode responses (no attention check)
-    if element['SurveyAnswer'] == 'Never (0%)':
-        lsas_df.at[element['UserId'], 'Response'] = 0
-    elif element['SurveyAnswer'] == 'Occasionally (1-33%)':
-        lsas_df.at[element['UserId'], 'Response'] = 1
-    elif element['SurveyAnswer'] == 'Often (34-66%)':
-        lsas_df.at[element['UserId'], 'Response'] = 2
-    elif element['SurveyAnswer'] == 'Usually (67-100%)':
-        lsas_df.at[element['UserId'], 'Response'] = 3
-    elif element['SurveyAnswer'] == '':
-        lsas_df.at[element['UserId'], 'Response'] = np.nan
-    
-    lsas_df.at[element['UserId'], 'Question'] = element['Que']
-
-    # convert timestamp
-    tmp_date = datetime.strptime(element['Timestamp'], "%Y-%m-%d %H:%M:%S.%f")
-    lsas_df.at[element['UserId'], 'Year'] = int(tmp_date.year)
-    lsas_df.at[element['UserId'], 'Month'] = int(tmp_date.month)
-    lsas_df.at[element['UserId'], 'Day'] = int(tmp_date.day)
-    lsas_df.at[element['UserId'], 'Hour'] = int(tmp_date.hour)
-    lsas_df.at[element['UserId'], 'Minute'] = int(tmp_date.minute)
-    lsas_df.at[element['UserId'], 'Second'] = int(tmp_date.second)
-
-    return lsas_df
-    
+    return _record_frame('LSAS', element['UserId'], _lsas_row(element))
+
 def get_hardball(element):
     assert type(element) is dict, 'Input should be dictionary'
     assert ('Game' in element.keys()), '"Game" should exist in dictionary'
     assert ('Screen' not in element.keys()), '"Screen" should NOT exist in dictionary -- Use to get subjective influence ratings'
     assert (element['Game'] == 'Hardball'), '"Game" should be "Hardball"'
 
-    hardball_df = pd.DataFrame(index=[element['UserId']], 
-                               columns=['Condition','OpponentNum',
-                                        'Game','TeamName',
-                                        'Opponent','Offer',
-                                        'Response','Accept','Reject','Reward',
-                                        'Year', 'Month','Day',
-                                        'Hour','Minute','Second'])
-
-    hardball_df.at[element['UserId'], 'Condition'] = element['Condition']
-    hardball_df.at[element['UserId'], 'OpponentNum'] = element['OpponentNum']
-    hardball_df.at[element['UserId'], 'Game']  = element['Game']
-    hardball_df.at[element['UserId'], 'TeamName'] = element['TeamName']
-    hardball_df.at[element['UserId'], 'Opponent'] = element['Opponent']
-    hardball_df.at[element['UserId'], 'Offer'] = float(element['Offer'].strip('$'))
-    hardball_df.at[element['UserId'], 'Response'] = element['Response']
-
-    # recode responses with 1s and 0s and add reward if accept
-    if element['Response'] == 'Accept':
-        hardball_df.at[element['UserId'], 'Accept'] = 1
-        hardball_df.at[element['UserId'], 'Reject'] = 0
-        hardball_df.at[element['UserId'], 'Reward'] = float(element['Offer'].strip('$'))
-    else:
-        hardball_df.at[element['UserId'], 'Accept'] = 0
-        hardball_df.at[element['UserId'], 'Reject'] = 1
-        hardball_df.at[element['UserId'], 'Reward'] = 0.0
-
-    # convert timestamp
-    tmp_date = datetime.strptime(element['Timestamp'], "%Y-%m-%d %H:%M:%S.%f")
-    hardball_df.at[element['UserId'], 'Year'] = int(tmp_date.year)
-    hardball_df.at[element['UserId'], 'Month'] = int(tmp_date.month)
-    hardball_df.at[element['UserId'], 'Day'] = int(tmp_date.day)
-    hardball_df.at[element['UserId'], 'Hour'] = int(tmp_date.hour)
-    hardball_df.at[element['UserId'], 'Minute'] = int(tmp_date.minute)
-    hardball_df.at[element['UserId'], 'Second'] = int(tmp_date.second)
-
-    return hardball_df
+    return _record_frame('Hardball', element['UserId'], _hardball_row(element))
 
 def get_hardball_ratings(element):
     assert type(element) is dict, 'Input should be dictionary'
@@ -375,83 +440,287 @@ def get_hardball_ratings(element):
     assert ('Screen' in element.keys()), '"Screen" should exist in dictionary'
     assert (element['Game'] == 'Hardball'), '"Game" should be "Hardball"'
 
-    hardball_behav_df = pd.DataFrame(index=[element['UserId']], 
-                                    columns=['Game','TeamName','Rate',
-                                                'Year', 'Month','Day',
-                                                'Hour','Minute','Second'])
+    return _record_frame('HardballSubjectiveRatings', element['UserId'], _hardball_ratings_row(element))
 
-    hardball_behav_df.at[element['UserId'], 'Game']  = element['Game']
-    hardball_behav_df.at[element['UserId'], 'TeamName'] = element['TeamName']
-    hardball_behav_df.at[element['UserId'], 'Rate'] = element['Rate']
+def get_journey(element):
+    record = _journey_row(element)
+    assert record is not None, 'Journey element has no decision, memory, dots or task version data'
 
-    # convert timestamp
-    tmp_date = datetime.strptime(element['Timestamp'], "%Y-%m-%d %H:%M:%S.%f")
-    hardball_behav_df.at[element['UserId'], 'Year'] = int(tmp_date.year)
-    hardball_behav_df.at[element['UserId'], 'Month'] = int(tmp_date.month)
-    hardball_behav_df.at[element['UserId'], 'Day'] = int(tmp_date.day)
-    hardball_behav_df.at[element['UserId'], 'Hour'] = int(tmp_date.hour)
-    hardball_behav_df.at[element['UserId'], 'Minute'] = int(tmp_date.minute)
-    hardball_behav_df.at[element['UserId'], 'Second'] = int(tmp_date.second)
+    task_name, row = record
+    return [task_name, _record_frame('Journey_' + task_name, element['UserId'], row)]
 
-    return hardball_behav_df
+JOURNEY_MIN_TRIALS = 63 # decisions of a completed Journey
+JOURNEY_SESSION_GAP = 60 * 30 # seconds between decisions that start a new session
 
-def get_journey(element):
-    char_roles = ['First', 'Second', 'Assistant', 'Newcomb', 'Hayworth', 'Neutral'] 
-    sub_id = element['UserId']
-
-    if any(name in element for name in ['SlideNum', 'Task', 'CharFirstX']):
-
-        # get task version info
-        if 'SlideNum' in element:
-
-            if element['SlideNum'] == 1:
-                snt_df = pd.DataFrame(index=[sub_id], 
-                                      columns=list(np.array([[char + '_name', 
-                                                              char + '_gender', 
-                                                              char + '_image'] for char in char_roles]).flatten()))
-                characters = []
-                for role in char_roles:
-                    name = element['CharName' + role]
-                    img = element['CharImage' + role].split('/')[-1]
-                    gender = element['CharGender' + role]
-                    characters.append([name, gender, img])
-                snt_df.at[sub_id, :] = list(np.array(characters).flatten())
-                task_name = 'characters'
-
-        # get task data
-        if 'Task' in element:
-
-            task = element['Task']
-            time_on = element['Timestamp']
-
-            if 'Decision' in task: 
-                snt_df = pd.DataFrame(index=[sub_id], columns=['decision_num','decision'],
-                                      data=np.array([task, element['JourneyAnswer']]).reshape(1,-1))
-                task_name = 'decisions'
-
-            elif ('Attention' in task) or ('Memory' in task):
-                snt_df = pd.DataFrame(index=[sub_id], columns=['question_num','answer'],
-                                      data=np.array([task, element['Option']]).reshape(1,-1))
-                task_name = 'memory' 
-
-        # get dots data
-        elif 'CharFirstX' in element:
-
-            dots = list(np.array([[element['Char'+role+'X'], element['Char'+role+'Y']] for role in char_roles]).flatten())
-            snt_df = pd.DataFrame(index=[sub_id], columns=list(np.array([['dots_' + char + '_affil', 'dots_' + char + '_power'] for char in char_roles]).flatten()),
-                                  data=dots)
-            task_name = 'dots'
-
-        # convert timestamp
-        tmp_date = datetime.strptime(element['Timestamp'], "%Y-%m-%d %H:%M:%S.%f")
-        snt_df.at[element['UserId'], 'Datetime'] = element['Timestamp']
-        snt_df.at[element['UserId'], 'Year'] = int(tmp_date.year)
-        snt_df.at[element['UserId'], 'Month'] = int(tmp_date.month)
-        snt_df.at[element['UserId'], 'Day'] = int(tmp_date.day)
-        snt_df.at[element['UserId'], 'Hour'] = int(tmp_date.hour)
-        snt_df.at[element['UserId'], 'Minute'] = int(tmp_date.minute)
-        snt_df.at[element['UserId'], 'Second'] = int(tmp_date.second)
-
-        output = [task_name, snt_df]
-
-    return output
\ No newline at end of file
+def _subject_rows(df, subj_ids):
+    # rows of the given subjects, sorted by subject (stable, so each subject keeps its row order)
+    return partition_by_subject(df[df.index.get_level_values(0).isin(subj_ids)]).data.copy()
+
+def get_journey_sessions(decisions_df, characters_df, memory_df, min_trials=JOURNEY_MIN_TRIALS, session_gap=JOURNEY_SESSION_GAP):
+    '''
+    Preprocesses the Journey (SNT) records of all subjects (the index) at once.
+    Subjects with at least min_trials decisions are kept. Their decisions get Num_trials, Include,
+    Session (a new session starts after more than session_gap seconds between decisions),
+    Elapsed(s) (whole seconds since the previous decision), Num_repeats (times the subject
+    made that decision) and Mult_versions (1 if the subject has more than one task version).
+    Each subject's decisions are sorted by Timestamp first (stable, so decisions with the same
+    Timestamp keep their export order), so Elapsed(s) is never negative even when an export
+    delivers decisions out of order.
+    Returns the decisions (sorted by subject and time), memory and characters (task versions)
+    of the kept subjects, sorted by subject.
+    '''
+    ntrials = decisions_df.index.get_level_values(0).value_counts()
+    subj_ids = ntrials.index[ntrials >= min_trials]
+
+    snt_df = _subject_rows(decisions_df, subj_ids)
+    subj_codes = pd.factorize(snt_df.index.get_level_values(0))[0]
+    # each subject's decisions in time order
+    order = np.lexsort((snt_df['Timestamp'].to_numpy(), subj_codes))
+    snt_df, subj_codes = snt_df.iloc[order].copy(), subj_codes[order]
+    first_trials = np.r_[True, subj_codes[1:] != subj_codes[:-1]] if len(snt_df) else np.zeros(0, bool)
+
+    snt_df['Num_trials'] = ntrials.reindex(snt_df.index.get_level_values(0)).to_numpy()
+    snt_df['Include'] = 1
+
+    # if two trials are > session_gap seconds apart they are in separate sessions
+    elapsed = np.zeros(len(snt_df), dtype=np.int64)
+    elapsed[1:] = np.diff(snt_df['Timestamp'].to_numpy()) // np.timedelta64(1, 's')
+    elapsed[first_trials] = 0
+    snt_df['Session'] = pd.Series(elapsed > session_gap).groupby(subj_codes).cumsum().to_numpy() + 1
+    snt_df['Elapsed(s)'] = elapsed
+
+    # number of repeats of each decision
+    repeats = pd.DataFrame({'SubjectID': subj_codes, 'decision_num': pd.factorize(snt_df['decision_num'])[0]})
+    snt_df['Num_repeats'] = repeats.groupby(['SubjectID', 'decision_num'])['SubjectID'].transform('size').to_numpy()
+
+    # more than one task version
+    nversions = characters_df.index.get_level_values(0).value_counts()
+    snt_df['Mult_versions'] = (nversions.reindex(snt_df.index.get_level_values(0)).fillna(0) > 1).astype(int).to_numpy()
+
+    return snt_df, _subject_rows(memory_df, subj_ids), _subject_rows(characters_df, subj_ids)
+
+def get_records(element):
+    '''
+    Returns a list of (record_type, row) for every record contained in a json element,
+    following the same dispatch as the per-element get_* functions:
+    Age -> Demographics, SurveyName -> OCI/SDS/LSAS, Game -> Hardball/HardballSubjectiveRatings/Journey_*
+    '''
+    records = []
+
+    # Get Demographics
+    if 'Age' in element:
+        records.append(('Demographics', _demographics_row(element)))
+
+    # Get Survey Data
+    if 'SurveyName' in element:
+        if element['SurveyName'] == 'OCI':
+            records.append(('OCI', _oci_row(element)))
+        elif element['SurveyName'] == 'SDS':
+            records.append(('SDS', _sds_row(element)))
+        elif element['SurveyName'] == 'LSAS':
+            records.append(('LSAS', _lsas_row(element)))
+
+    # Get Game Data
+    if 'Game' in element:
+        if element['Game'] == 'Hardball':
+            if 'Screen' in element:
+                records.append(('HardballSubjectiveRatings', _hardball_ratings_row(element)))
+            else:
+                records.append(('Hardball', _hardball_row(element)))
+
+        elif element['Game'] == 'Journey':
+            record = _journey_row(element)
+            if record is not None:
+                records.append(('Journey_' + record[0], record[1]))
+
+    return records
+
+def get_record_types(element):
+    '''
+    Returns the record types of the records in a json element (as get_records, but from the
+    dispatch keys only: the rows are not built, so fields they need may be missing).
+    '''
+    record_types = []
+    if 'Age' in element:
+        record_types.append('Demographics')
+    if element.get('SurveyName') in ('OCI', 'SDS', 'LSAS'):
+        record_types.append(element['SurveyName'])
+    if 'Game' in element:
+        if element['Game'] == 'Hardball':
+            record_types.append('HardballSubjectiveRatings' if 'Screen' in element else 'Hardball')
+        elif element['Game'] == 'Journey':
+            task_name = _journey_task(element)
+            if task_name is not None:
+                record_types.append('Journey_' + task_name)
+    return record_types
+
+def element_records(element):
+    '''
+    Returns the UserId and the records (see get_records) of a json element.
+    Raises if the element cannot be parsed.
+    '''
+    if not isinstance(element, dict):
+        raise TypeError(f'element should be a dictionary, not {type(element).__name__}')
+    return element['UserId'], get_records(element)
+
+def _convert_column(col, dtype):
+    if dtype == 'category':
+        return col.astype('category')
+    if dtype == 'str':
+        return col.where(col.isna(), col.astype(str))
+
+    # numeric columns with values that are not numbers are left as they are
+    try:
+        values = pd.to_numeric(col)
+    except (ValueError, TypeError):
+        return col
+    if dtype == 'numeric':
+        return pd.to_numeric(values, downcast='integer') if not values.isna().any() else values
+    if dtype.startswith('int') and values.isna().any():
+        return values.astype('float64')
+    return values.astype(dtype)
+
+def apply_schema(df, record_type):
+    '''
+    Gives the columns of a parsed record type their dtypes from RECORD_SCHEMAS
+    and adds the "Timestamp" column if missing (e.g. for frames of the get_* functions). Also use after concatenating parsed frames,
+    as categories of different frames are not merged by pd.concat.
+    '''
+    for col, dtype in RECORD_SCHEMAS[record_type].items():
+        if col in df.columns:
+            df[col] = _convert_column(df[col], dtype)
+
+    if 'Timestamp' not in df.columns:
+        df['Timestamp'] = pd.to_datetime(df[TIME_COLUMNS]).astype('datetime64[ns]')
+    return df
+
+def concat_records(dfs, record_type):
+    '''
+    Concatenates parsed frames of one record type, keeping the declared dtypes.
+    '''
+    return apply_schema(pd.concat(dfs), record_type)
+
+def memory_report(dfs):
+    '''
+    Memory use (MB) of each parsed table with object columns, as built by the get_* functions,
+    and with the declared schema.
+    '''
+    report = pd.DataFrame(index=list(dfs), columns=['Rows', 'ObjectMB', 'TypedMB'])
+    for record_type, df in dfs.items():
+        object_df = df.drop(columns=['Timestamp'], errors='ignore').astype(object)
+        report.at[record_type, 'Rows'] = len(df)
+        report.at[record_type, 'ObjectMB'] = object_df.memory_usage(deep=True).sum() / 1e6
+        report.at[record_type, 'TypedMB'] = df.memory_usage(deep=True).sum() / 1e6
+    report.loc['Total'] = report.sum()
+    report = report.astype({'Rows': int, 'ObjectMB': float, 'TypedMB': float})
+    report['Ratio'] = report['ObjectMB'] / report['TypedMB']
+    return report
+
+def error_reason(err):
+    return f'{type(err).__name__}: {err}'
+
+def valid_timestamp(timestamp):
+    '''
+    Whether a timestamp parses with TIMESTAMP_FORMAT (as when records are built),
+    without strptime for timestamps of the usual 'YYYY-MM-DD HH:MM:SS.ffffff' shape.
+    '''
+    try:
+        if len(timestamp) == 26 and timestamp[10] == ' ' and timestamp[19] == '.' and timestamp[20:].isdigit():
+            datetime.fromisoformat(timestamp)
+        else:
+            datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def invalid_timestamp_reason(record_type):
+    return f'ValueError: invalid Timestamp ({record_type})'
+
+class RecordBuffers:
+    '''
+    Column buffers for every record type.
+    Elements are added one at a time and each DataFrame is built once by to_frames().
+    '''
+    def __init__(self):
+        self.buffers = {}
+        self.invalid_timestamps = [] # (record_type, user_id, timestamp) of records dropped by to_frames
+        self.fingerprints = {} # per record type, fingerprint of the element of each record (if given)
+        self.row_fingerprints = {} # same for the rows of the frames returned by to_frames
+        self.invalid_fingerprints = set() # fingerprints of elements with records dropped by to_frames
+
+    def add_element(self, element, fingerprint=None):
+        '''
+        Adds all records of a json element and returns their record types.
+        Raises if the element cannot be parsed, in which case nothing is added.
+        fingerprint (e.g. from ingest.element_fingerprint), if given, is kept for each record.
+        '''
+        user_id, records = element_records(element)
+        for record_type, row in records:
+            if record_type not in self.buffers:
+                self.buffers[record_type] = ([], [[] for _ in range(len(RECORD_FIELDS[record_type]) + 1)])
+            index, columns = self.buffers[record_type]
+            index.append(user_id)
+            for column, value in zip(columns, row):
+                column.append(value)
+            if fingerprint is not None:
+                self.fingerprints.setdefault(record_type, []).append(fingerprint)
+        return [record_type for record_type, _ in records]
+
+    def to_frames(self):
+        '''
+        Returns one DataFrame per record type. Timestamps are parsed here, once per record type,
+        and records with a timestamp that does not parse are dropped (see invalid_timestamps).
+        '''
+        dfs = {}
+        self.invalid_timestamps = []
+        self.row_fingerprints = {}
+        self.invalid_fingerprints = set()
+        for record_type in RECORD_TYPES:
+            if record_type in self.buffers:
+                index, columns = self.buffers[record_type]
+                timestamps = pd.to_datetime(columns[-1], format=TIMESTAMP_FORMAT, errors='coerce')
+
+                data = dict(zip(RECORD_FIELDS[record_type], columns[:-1]))
+                for col, values in zip(TIME_COLUMNS, [timestamps.year, timestamps.month, timestamps.day,
+                                                      timestamps.hour, timestamps.minute, timestamps.second]):
+                    data[col] = np.asarray(values)
+                data['Timestamp'] = timestamps
+                df = pd.DataFrame(data, index=index)
+
+                invalid = np.asarray(timestamps.isna())
+                if invalid.any():
+                    self.invalid_timestamps += [(record_type, index[i], columns[-1][i]) for i in np.flatnonzero(invalid)]
+                    df = df[~invalid]
+
+                if record_type in self.fingerprints:
+                    fingerprints = np.array(self.fingerprints[record_type], dtype=np.uint64)
+                    self.row_fingerprints[record_type] = fingerprints[~invalid]
+                    self.invalid_fingerprints.update(fingerprints[invalid].tolist())
+                dfs[record_type] = apply_schema(df, record_type)
+        return dfs
+
+def parse_elements(elements, skipped=None):
+    '''
+    Batch version of the get_* functions.
+    Takes a list or iterator of json elements and returns a dictionary with one DataFrame
+    per record type (indexed by UserId, same columns and values as the get_* functions).
+    Values are collected in column buffers and each DataFrame is built once.
+
+    If skipped is a list, elements that fail to parse are appended to it as (element, reason)
+    and parsing continues, otherwise the error is raised.
+    '''
+    buffers = RecordBuffers()
+    for element in elements:
+        try:
+            buffers.add_element(element)
+        except Exception as err:
+            if skipped is None:
+                raise
+            skipped.append((element, error_reason(err)))
+
+    dfs = buffers.to_frames()
+    for record_type, user_id, timestamp in buffers.invalid_timestamps:
+        if skipped is None:
+            raise ValueError(f'Invalid Timestamp {timestamp!r} of {record_type} record of {user_id}')
+        skipped.append(({'UserId': user_id, 'Timestamp': timestamp}, invalid_timestamp_reason(record_type)))
+    return dfs
@@ -0,0 +1,184 @@
+import pandas as pd, numpy as np, json, os
+from collections.abc import Mapping
+
+try:
+    import pyarrow as pa, pyarrow.parquet as pq, pyarrow.feather as feather
+except ImportError: # optional, only needed for the columnar store
+    pa = None
+
+FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+SUBJECTS_KEY = b'subject_offsets' # arrow schema metadata of tables written from a SubjectPartition
+
+def _check_pyarrow():
+    if pa is None:
+        raise ImportError('The columnar store needs pyarrow (pip install pyarrow)')
+
+def to_arrow(df):
+    '''
+    Converts a DataFrame to an arrow table (with the index) after giving object columns a type:
+    columns of one kind of value get that type, columns mixing kinds of values are stored as strings
+    (as are the categories of categorical columns mixing kinds of categories).
+    '''
+    _check_pyarrow()
+    df = df.infer_objects()
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed'):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    for col in df.columns[[isinstance(dtype, pd.CategoricalDtype) for dtype in df.dtypes]]:
+        if pd.api.types.infer_dtype(df[col].cat.categories, skipna=True).startswith('mixed'):
+            values = df[col].astype(object)
+            df[col] = values.where(values.isna(), values.astype(str)).astype('category')
+    return pa.Table.from_pandas(df, preserve_index=True)
+
+class SubjectPartition(Mapping):
+    '''
+    Rows of a table grouped by subject (sorted, each subject keeping its row order) with the offset
+    of each subject's rows, so partition[subj_id] is a slice found in constant time (no scan, no copy)
+    and iterating over partition.items() visits every subject once.
+    Built with partition_by_subject, or read from a store with read_partition, in which case each
+    subject's rows are only read (from a memory-mapped Feather file) when used.
+    '''
+    def __init__(self, data, subjects, offsets):
+        self.data = data # DataFrame, or arrow table when read from a store
+        self.subjects = pd.Index(subjects)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def _rows(self, lo, hi):
+        if isinstance(self.data, pd.DataFrame):
+            return self.data.iloc[lo:hi]
+        return self.data.slice(lo, hi - lo).to_pandas()
+
+    def __getitem__(self, subj_id):
+        i = self.subjects.get_loc(subj_id)
+        return self._rows(self.offsets[i], self.offsets[i + 1])
+
+    def __iter__(self):
+        return iter(self.subjects)
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def n_rows(self, subj_id):
+        i = self.subjects.get_loc(subj_id)
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def to_frame(self):
+        return self._rows(0, self.offsets[-1])
+
+    def to_arrow(self):
+        table = to_arrow(self.data) if isinstance(self.data, pd.DataFrame) else self.data
+        offsets = json.dumps({'subjects': self.subjects.tolist(), 'offsets': self.offsets.tolist()})
+        return table.replace_schema_metadata({**(table.schema.metadata or {}), SUBJECTS_KEY: offsets.encode()})
+
+def partition_by_subject(df, subject_col=None):
+    '''
+    Returns the rows of df grouped by subject (subject_col or the index) as a SubjectPartition,
+    sorting once (stable, so each subject keeps its row order).
+    '''
+    subj_ids = df[subject_col] if subject_col is not None else df.index.get_level_values(0)
+    subj_codes, subjects = pd.factorize(subj_ids, sort=True)
+    order = np.argsort(subj_codes, kind='stable')
+    offsets = np.searchsorted(subj_codes[order], np.arange(len(subjects) + 1))
+    return SubjectPartition(df.iloc[order], subjects, offsets)
+
+def table_path(store_dir, table, date=None, format='parquet'):
+    name = table if date is None else date
+    return os.path.join(store_dir, table, name + FORMATS[format])
+
+def write_tables(dfs, store_dir, date=None, format='parquet', compression='zstd'):
+    '''
+    Writes a dictionary of DataFrames to a columnar store, one folder per table:
+    <store_dir>/<table>/<date>.parquet (or <table>.parquet without a date).
+    format is 'parquet' (smaller, column subset reads) or 'feather' (memory-mapped reads).
+    Tables can also be SubjectPartitions, whose subject offsets are kept (see read_partition);
+    write them as uncompressed feather to read single subjects without reading the rest.
+    Returns the paths written.
+    '''
+    _check_pyarrow()
+    paths = {}
+    for table, df in dfs.items():
+        path = table_path(store_dir, table, date, format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrow_table = df.to_arrow() if isinstance(df, SubjectPartition) else to_arrow(df)
+        if format == 'parquet':
+            pq.write_table(arrow_table, path, compression=compression)
+        else:
+            feather.write_feather(arrow_table, path, compression=compression)
+        paths[table] = path
+    return paths
+
+def read_table(path, columns=None, memory_map=True):
+    '''
+    Reads one table of the store, optionally only some columns (the index is always read).
+    Feather files are memory-mapped, so only the columns used are paged in.
+    '''
+    _check_pyarrow()
+    if path.endswith(FORMATS['parquet']):
+        table = pq.read_table(path, columns=columns, memory_map=memory_map, use_pandas_metadata=True)
+    else:
+        table = feather.read_table(path, columns=columns, memory_map=memory_map)
+    return table.to_pandas()
+
+def read_partition(path, memory_map=True):
+    '''
+    Reads a table written from a SubjectPartition as a SubjectPartition. For an uncompressed feather
+    file only the subject offsets are read here, and each subject's rows when used.
+    '''
+    _check_pyarrow()
+    if path.endswith(FORMATS['parquet']):
+        table = pq.read_table(path, memory_map=memory_map)
+    else:
+        table = feather.read_table(path, memory_map=memory_map)
+    metadata = (table.schema.metadata or {}).get(SUBJECTS_KEY)
+    if metadata is None:
+        raise ValueError(f'{path} was not written from a SubjectPartition')
+    offsets = json.loads(metadata)
+    return SubjectPartition(table, offsets['subjects'], offsets['offsets'])
+
+class TableStore(Mapping):
+    '''
+    Dictionary of DataFrames backed by a columnar store written with write_tables,
+    as a drop-in for the preproc_dfs pickle: store['Hardball'] reads the table on first use
+    (and keeps it), store.read('Hardball', columns=[...]) reads only some columns.
+    Uses the given date, or the latest date of each table.
+    '''
+    def __init__(self, store_dir, date=None, memory_map=True):
+        self.store_dir = store_dir
+        self.date = date
+        self.memory_map = memory_map
+        self._paths = {}
+        self._loaded = {}
+
+        for table in sorted(os.listdir(store_dir)):
+            files = sorted(f for f in os.listdir(os.path.join(store_dir, table))
+                           if os.path.splitext(f)[1] in FORMATS.values())
+            if date is not None:
+                files = [f for f in files if os.path.splitext(f)[0] in (date, table)]
+            if files:
+                self._paths[table] = os.path.join(store_dir, table, files[-1])
+
+    def read(self, table, columns=None):
+        return read_table(self._paths[table], columns=columns, memory_map=self.memory_map)
+
+    def subjects(self, table):
+        '''
+        Returns a table written from a SubjectPartition as a SubjectPartition (see read_partition).
+        '''
+        return read_partition(self._paths[table], memory_map=self.memory_map)
+
+    def __getitem__(self, table):
+        if table not in self._loaded:
+            self._loaded[table] = self.read(table)
+        return self._loaded[table]
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+def load_tables(store_dir, date=None, memory_map=True):
+    '''
+    Returns the tables of a store as a dictionary of DataFrames that are only read when used.
+    '''
+    return TableStore(store_dir, date=date, memory_map=memory_map)
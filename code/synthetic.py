@@ -0,0 +1,144 @@
+import json, os, random
+from datetime import datetime, timedelta
+
+from socialbrainapp import CHAR_ROLES, INSTRUMENTS, TIMESTAMP_FORMAT, HARDBALL_BLOCK_LEN
+
+# Synthetic Social Brain App exports, with the keys the get_* functions expect, for benchmarks
+# and for trying the pipeline without participant data. All values are made up.
+
+CONDITIONS = ['Control', 'NoControl']
+ANSWERS = {'Age': ['18-24', '25-34', '35-44', '45-54', '55+'], 'Gender': ['Female', 'Male', 'Other'],
+           'Race': ['White', 'Black', 'Asian', 'Other'], 'Ethnicity': ['Hispanic', 'Not Hispanic'],
+           'Education': ['High school', 'College', 'Graduate'], 'Income': ['<25k', '25-50k', '50-100k', '>100k']}
+
+def _survey_elements(rand, add, instrument, completion):
+    spec = INSTRUMENTS[instrument]
+    answers = [answer for answer in spec['answers'] if answer != '']
+    n_items = spec['n_items'] if rand.random() < completion else rand.randint(1, spec['n_items'] - 1)
+    for item in range(1, n_items + 1):
+        # the attention check item is meant to be left unanswered
+        answer = '' if item == spec['attention_item'] and rand.random() < 0.9 else rand.choice(answers)
+        add(seconds=rand.randint(2, 8), SurveyName=instrument, SurveyQuestion=item, SurveyAnswer=answer,
+            Que=f'{instrument} question {item}')
+
+def _hardball_elements(rand, add, plays, incomplete_blocks):
+    for play in range(plays):
+        conditions = rand.sample(CONDITIONS, len(CONDITIONS))
+        for condition in conditions:
+            team = f'Team{rand.randint(1, 20)}'
+            n_opponents = HARDBALL_BLOCK_LEN if rand.random() >= incomplete_blocks else rand.randint(1, HARDBALL_BLOCK_LEN - 1)
+            for opponent in range(1, n_opponents + 1):
+                add(seconds=rand.randint(1, 6), Game='Hardball', Condition=condition, OpponentNum=opponent, TeamName=team,
+                    Opponent=f'Opponent{rand.randint(1, 200)}', Offer=f'${rand.randint(1, 9)}.00',
+                    Response=rand.choice(['Accept', 'Reject']))
+            add(seconds=rand.randint(3, 20), Game='Hardball', Screen='Rate', TeamName=team, Rate=rand.randint(0, 100))
+        # replays come minutes to days later
+        add(seconds=0 if play == plays - 1 else rand.choice([300, 3600, 86400 * rand.randint(1, 14)]), skip=True)
+
+def _journey_elements(rand, add, n_decisions):
+    characters = {}
+    for role in CHAR_ROLES:
+        characters['CharName' + role] = f'{role}Name{rand.randint(1, 9)}'
+        characters['CharImage' + role] = f'Journey/Characters/{role}{rand.randint(1, 9)}.png'
+        characters['CharGender' + role] = rand.choice(['F', 'M'])
+    add(seconds=rand.randint(5, 60), Game='Journey', SlideNum=1, **characters)
+    add(seconds=rand.randint(5, 60), Game='Journey', SlideNum=2)
+
+    for decision in range(1, n_decisions + 1):
+        # now and then the task is picked up again after a break
+        gap = rand.randint(1800, 7200) if rand.random() < 0.01 else rand.randint(2, 30)
+        add(seconds=gap, Game='Journey', Task=f'Decision{decision}', JourneyAnswer=rand.choice([1, 2]))
+        if decision % 10 == 0:
+            add(seconds=rand.randint(2, 10), Game='Journey', Task=f'Memory{decision // 10}', Option=rand.choice('ABCD'))
+        if decision % 20 == 0:
+            dots = {f'Char{role}{axis}': round(rand.uniform(-1, 1), 3) for role in CHAR_ROLES for axis in 'XY'}
+            add(seconds=rand.randint(2, 10), Game='Journey', **dots)
+
+def _malformed(rand, element):
+    kind = rand.choice(['missing field', 'invalid timestamp', 'not an object'])
+    if kind == 'missing field':
+        keys = [key for key in element if key not in ('UserId', 'Timestamp')]
+        if keys:
+            element = dict(element)
+            del element[rand.choice(keys)]
+        return element
+    if kind == 'invalid timestamp':
+        return {**element, 'Timestamp': element['Timestamp'][:10] + ' ??:??'}
+    return json.dumps(element)
+
+def subject_elements(rand, user_id, start, hardball_plays=(1, 3), incomplete_blocks=0.05, survey_completion=0.9,
+                     journey_decisions=(40, 63, 70), withdrawals=0.02, data_withdrawals=0.01, malformed=0.0):
+    '''
+    Returns the json elements of one subject, in time order from start:
+    demographics, OCI/SDS/LSAS (completed with probability survey_completion), Hardball plays
+    (a number of plays drawn from hardball_plays, each a block per condition followed by a rating;
+    a block is cut short with probability incomplete_blocks) and the Journey (a number of decisions
+    drawn from journey_decisions, with memory, dots and task version elements).
+    withdrawals / data_withdrawals are the probabilities of Withdrawal / WithdrawalShare,
+    malformed the probability that an element is broken (a missing field, an invalid timestamp
+    or not a json object).
+    '''
+    elements = []
+    clock = [start]
+
+    def add(seconds=0, skip=False, **fields):
+        clock[0] += timedelta(seconds=seconds, microseconds=rand.randint(0, 999999))
+        if not skip:
+            elements.append({'UserId': user_id, **fields, 'Timestamp': clock[0].strftime(TIMESTAMP_FORMAT)})
+
+    add(**{key: rand.choice(values) for key, values in ANSWERS.items()}, Zip=f'{rand.randint(1000, 99999):05d}',
+        Withdrawal=str(rand.random() < withdrawals), HasPreviouslyInstalled=str(rand.random() < 0.1))
+    if rand.random() < data_withdrawals:
+        add(seconds=rand.randint(1, 86400), WithdrawalShare='True')
+
+    for instrument in INSTRUMENTS:
+        _survey_elements(rand, add, instrument, survey_completion)
+    _hardball_elements(rand, add, rand.randint(*hardball_plays), incomplete_blocks)
+    _journey_elements(rand, add, rand.choice(journey_decisions))
+
+    if malformed:
+        elements = [_malformed(rand, element) if rand.random() < malformed else element for element in elements]
+    return elements
+
+def write_exports(out_dir, n_subjects, n_files=10, duplicates=0.0, start=datetime(2023, 1, 1), enrollment_days=365,
+                  seed=0, **kwargs):
+    '''
+    Writes the elements of n_subjects synthetic subjects (see subject_elements for kwargs) to n_files
+    json exports in out_dir, one subject at a time so memory stays bounded by one subject.
+    Subjects enroll over enrollment_days from start. With probability duplicates an element is
+    delivered again in the next export, as overlapping exports do.
+    Returns the paths written.
+    '''
+    rand = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    redelivered = []
+    subjects_per_file = -(-n_subjects // n_files)
+    for file_num in range(n_files):
+        path = os.path.join(out_dir, f'SocialBrainApp-export-{file_num:04d}.json')
+        next_redelivered = []
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write('[')
+            first = True
+            for element in redelivered:
+                handle.write(('' if first else ',\n') + json.dumps(element))
+                first = False
+
+            for subj_num in range(file_num * subjects_per_file, min(n_subjects, (file_num + 1) * subjects_per_file)):
+                subj_start = start + timedelta(seconds=rand.randint(0, enrollment_days * 86400))
+                for element in subject_elements(rand, f'SBA{subj_num:07d}', subj_start, **kwargs):
+                    handle.write(('' if first else ',\n') + json.dumps(element))
+                    first = False
+                    if duplicates and rand.random() < duplicates:
+                        next_redelivered.append(element)
+            handle.write(']\n')
+
+        # duplicates of the last export go into that same export
+        if file_num == n_files - 1 and next_redelivered:
+            with open(path, 'r+', encoding='utf-8') as handle:
+                handle.seek(0, os.SEEK_END)
+                handle.seek(handle.tell() - 2)
+                handle.write(''.join(',\n' + json.dumps(element) for element in next_redelivered) + ']\n')
+        redelivered = next_redelivered
+        paths.append(path)
+    return paths